@@ -0,0 +1,225 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy
+
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+import pydicom_split
+
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+LAYOUTS = {
+    # patient name, split arguments
+    'single': ('BENCH_1001_1002_1003', dict(n=3, order='1,1,1')),
+    'two': ('BENCH_M1(T)_M2(Rp)_M3(L)',
+            dict(nTB=['1,2'], orderT='1', orderB='1,1')),
+    'grid': ('BENCH_2001_2002_2003_2004_2005_2006_2007_2008_2009',
+             dict(grid='3,3,3', order='1,1,1,1,1,1,1,1,1')),
+}
+SPLITTERS = {
+    'single': 'DICOMSplitter',
+    'two': 'DICOMSplitterTB',
+    'grid': 'DICOMSplitterGrid',
+}
+MODES = {
+    'serial': dict(),
+    'volume': dict(volume=True),
+    'pipeline': dict(pipeline=True),
+    'workers': dict(workers=os.cpu_count()),
+}
+
+
+def synthetic_volume(layout, rows, columns, slices, bits, seed=0):
+    # a bright disc per subject on a noisy background
+    random = numpy.random.RandomState(seed)
+    dtype = numpy.dtype('uint%d' % bits)
+    maximum = min(numpy.iinfo(dtype).max, 4095)
+    volume = random.randint(0, maximum // 20, (slices, rows, columns)).astype(dtype)
+    if layout == 'single':
+        centres = [(rows / 2, columns * (2 * i + 1) / 6) for i in range(3)]
+    elif layout == 'grid':
+        centres = [(rows * (2 * i + 1) / 6, columns * (2 * j + 1) / 6)
+                   for i in range(3) for j in range(3)]
+    else:
+        centres = [(rows / 4, columns / 2),
+                   (rows * 3 / 4, columns / 4), (rows * 3 / 4, columns * 3 / 4)]
+    r, c = numpy.ogrid[:rows, :columns]
+    radius = min(rows, columns) / (16 if layout == 'grid' else 8)
+    for centre_r, centre_c in centres:
+        disc = (r - centre_r) ** 2 + (c - centre_c) ** 2 < radius ** 2
+        volume[:, disc] = maximum // 2
+    return volume
+
+
+def synthetic_dataset(pixel_array, z, patient_name, study_instance_uid,
+                      series_instance_uid):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset = FileDataset(None, Dataset(), file_meta=file_meta,
+                          preamble=b'\0' * 128, is_implicit_VR=False,
+                          is_little_endian=True)
+    dataset.SOPClassUID = CT_IMAGE_STORAGE
+    dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    dataset.StudyInstanceUID = study_instance_uid
+    dataset.SeriesInstanceUID = series_instance_uid
+    dataset.Modality = 'CT'
+    dataset.PatientName = patient_name
+    dataset.PatientID = patient_name
+    dataset.SeriesNumber = 1
+    dataset.SeriesDescription = 'benchmark'
+    dataset.InstanceNumber = z + 1
+    dataset.ImagePositionPatient = [0, 0, z]
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.PixelSpacing = [0.5, 0.5]
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.Rows, dataset.Columns = pixel_array.shape
+    dataset.BitsAllocated = pixel_array.dtype.itemsize * 8
+    dataset.BitsStored = dataset.BitsAllocated
+    dataset.HighBit = dataset.BitsAllocated - 1
+    dataset.PixelRepresentation = 0
+    dataset.PixelData = pixel_array.tobytes()
+    return dataset
+
+
+def write_series(directory, layout, rows, columns, slices, bits):
+    patient_name = LAYOUTS[layout][0]
+    volume = synthetic_volume(layout, rows, columns, slices, bits)
+    study_instance_uid, series_instance_uid = generate_uid(), generate_uid()
+    os.makedirs(directory, exist_ok=True)
+    for z in range(slices):
+        dataset = synthetic_dataset(volume[z], z, patient_name,
+                                    study_instance_uid, series_instance_uid)
+        dataset.save_as(os.path.join(directory, '%06d.dcm' % z))
+    return volume.nbytes
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return usage / scale
+
+
+def run_splitter(layout, rows, columns, slices, bits, repeat):
+    volume = synthetic_volume(layout, rows, columns, slices, bits)
+    if layout == 'single':
+        splitter = pydicom_split.DICOMSplitter(None, 1, 3)
+    elif layout == 'grid':
+        splitter = pydicom_split.DICOMSplitterGrid(None, (3, 3, 3))
+    else:
+        splitter = pydicom_split.DICOMSplitterTB(None, 0, 1, 2)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for pixel_array in volume:
+            splitter.pixel_array = pixel_array
+            for _, _, split in splitter:
+                numpy.ascontiguousarray(split)
+    return time.perf_counter() - start, slices * repeat, volume.nbytes * repeat
+
+
+def run_directory(layout, rows, columns, slices, bits, repeat, mode):
+    root = tempfile.mkdtemp(prefix='pydicom_split_benchmark_')
+    try:
+        source = os.path.join(root, 'source')
+        nbytes = write_series(source, layout, rows, columns, slices, bits)
+        options = dict(LAYOUTS[layout][1], **MODES[mode])
+        elapsed = 0
+        for i in range(repeat):
+            output_dir = os.path.join(root, 'output%d' % i)
+            start = time.perf_counter()
+            pydicom_split.split_dicom_directory(
+                source, axis=1, output_dir=output_dir,
+                derivation_description='benchmark', **options)
+            elapsed += time.perf_counter() - start
+        return elapsed, slices * repeat, nbytes * repeat
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def run_case(case, layout, rows, columns, slices, bits, repeat):
+    # runs in a fresh process so the peak RSS belongs to this case only
+    warnings.simplefilter('ignore')
+    if case in SPLITTERS.values():
+        elapsed, files, nbytes = run_splitter(layout, rows, columns, slices,
+                                              bits, repeat)
+    else:
+        mode = case.split(':', 1)[1]
+        elapsed, files, nbytes = run_directory(layout, rows, columns, slices,
+                                               bits, repeat, mode)
+    return dict(case=case, layout=layout, rows=rows, columns=columns,
+                slices=slices, bits=bits, repeat=repeat, files=files,
+                seconds=elapsed, files_per_sec=files / elapsed,
+                mb_per_sec=nbytes / 2 ** 20 / elapsed,
+                peak_rss_mb=peak_rss_mb())
+
+
+def benchmark(layouts=('single', 'two', 'grid'), matrices=((512, 512),),
+              slices=(64,), bits=(16,), modes=('serial',), repeat=1):
+    cases = []
+    for layout in layouts:
+        for case in [SPLITTERS[layout]] + ['split_dicom_directory:%s' % m for m in modes]:
+            for rows, columns in matrices:
+                for n in slices:
+                    for b in bits:
+                        cases.append((case, layout, rows, columns, n, b, repeat))
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for case in cases:
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+            results.append(executor.submit(run_case, *case).result())
+    return dict(python=platform.python_version(), numpy=numpy.__version__,
+                pydicom=pydicom.__version__, cpu_count=os.cpu_count(),
+                results=results)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--layouts', nargs='*', default=['single', 'two', 'grid'],
+                        choices=sorted(LAYOUTS),
+                        help='single row, two row (top/bottom bed) and/or 3x3'
+                             ' grid series')
+    parser.add_argument('-m', '--matrices', nargs='*', default=['512x512'],
+                        help='matrix sizes as ROWSxCOLUMNS, default 512x512')
+    parser.add_argument('-z', '--slices', type=int, nargs='*', default=[64],
+                        help='slices per series, default 64')
+    parser.add_argument('-b', '--bits', type=int, nargs='*', default=[16],
+                        choices=[8, 16, 32], help='bits allocated, default 16')
+    parser.add_argument('-M', '--modes', nargs='*', default=['serial'],
+                        choices=sorted(MODES),
+                        help='split_dicom_directory modes, default serial')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='repeat every case, default 1')
+    parser.add_argument('-o', '--output', help='write the JSON report here'
+                                               ', default stdout')
+
+    kwargs = vars(parser.parse_args())
+    output = kwargs.pop('output')
+    kwargs['matrices'] = [tuple(map(int, matrix.lower().split('x')))
+                          for matrix in kwargs['matrices']]
+
+    report = benchmark(**kwargs)
+    if output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(output, 'w') as fp:
+            json.dump(report, fp, indent=2)
@@ -1,23 +1,251 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import contextlib
+import csv
 import copy
+import ctypes
+import ctypes.util
+import functools
+import io
+import json
 import math
 import os
+import queue
+import struct
 import sys
+import tarfile
+import threading
+import time
 import uuid
 import warnings
 import re
+import select
+import signal
+import sqlite3
+import zipfile
 
 import numpy
 
 import pydicom
+from pydicom.dataelem import DataElement
+from pydicom.multival import MultiValue
 from pydicom.sequence import Sequence
-from pydicom.dataset import Dataset
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.datadict import dictionary_VR
+from pydicom.pixel_data_handlers.util import pixel_dtype
+from pydicom.tag import Tag
+from pydicom.encaps import encapsulate
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_dataset
+from pydicom.pixel_data_handlers.rle_handler import rle_encode_frame
+from pydicom.uid import (UID, DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian,
+                         ImplicitVRLittleEndian, RLELossless)
+
+PIXEL_DATA = Tag('PixelData')
+DICOMDIR = 'DICOMDIR'
+INDEXED_KEYWORDS = ('SOPClassUID', 'SOPInstanceUID', 'StudyInstanceUID',
+                    'SeriesInstanceUID', 'PatientName', 'PatientID',
+                    'Modality', 'Rows', 'Columns', 'InstanceNumber',
+                    'ImagePositionPatient', 'ImageOrientationPatient',
+                    'PixelSpacing', 'NumberOfFrames', 'SamplesPerPixel',
+                    'BitsAllocated', 'PixelRepresentation')
+MAPPED_TRANSFER_SYNTAXES = (ExplicitVRLittleEndian, ImplicitVRLittleEndian)
+ARCHIVE_FORMATS = ('tar', 'zip')
+# lossless transfer syntaxes pydicom can write without extra packages
+ENCODINGS = collections.OrderedDict([('rle', RLELossless),
+                                     ('deflate', DeflatedExplicitVRLittleEndian)])
+# one row per output of a --plan file, boxes are row start, row stop,
+# column start, column stop
+PLAN_FIELDS = ('source', 'source_instance_uid', 'split', 'destination',
+               'box', 'image_position_patient', 'keep_origin', 'patient_name',
+               'patient_id', 'study_instance_uid', 'series_instance_uid',
+               'sop_instance_uid', 'series_description', 'series_number',
+               'derivation_description')
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seconds = collections.Counter()
+        self._calls = collections.Counter()
+        self._counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._seconds[name] += elapsed
+                self._calls[name] += 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(seconds=dict(self._seconds), calls=dict(self._calls),
+                        counters=dict(self._counters))
+
+    def merge(self, snapshot):
+        with self._lock:
+            self._seconds.update(snapshot['seconds'])
+            self._calls.update(snapshot['calls'])
+            self._counters.update(snapshot['counters'])
+
+    def write_json(self, path):
+        with open(path, 'w') as fp:
+            json.dump(self.snapshot(), fp, indent=2, sort_keys=True)
+
+    def write_prometheus(self, path):
+        snapshot = self.snapshot()
+        lines = ['# HELP pydicom_split_stage_seconds_total wall time per stage',
+                 '# TYPE pydicom_split_stage_seconds_total counter']
+        lines += ['pydicom_split_stage_seconds_total{stage="%s"} %f' % item
+                  for item in sorted(snapshot['seconds'].items())]
+        lines += ['# HELP pydicom_split_stage_calls_total calls per stage',
+                  '# TYPE pydicom_split_stage_calls_total counter']
+        lines += ['pydicom_split_stage_calls_total{stage="%s"} %d' % item
+                  for item in sorted(snapshot['calls'].items())]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines += ['# TYPE pydicom_split_%s_total counter' % name,
+                      'pydicom_split_%s_total %d' % (name, value)]
+        # the textfile collector must never see a partial file
+        with open(path + '.tmp', 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+# set while a run is profiled, the instrumentation below is a no-op otherwise
+metrics = None
+NOT_TIMED = contextlib.nullcontext()
+
+
+def timed(stage):
+    if metrics is None:
+        return NOT_TIMED
+    return metrics.stage(stage)
+
+
+def count(counter, value=1):
+    if metrics is not None:
+        metrics.count(counter, value)
+
+
+@contextlib.contextmanager
+def profiling(profile=None):
+    global metrics
+    previous = metrics
+    metrics = Metrics() if profile is None else profile
+    try:
+        yield metrics
+    finally:
+        metrics = previous
+
+
+def run_profiled(split, *args):
+    # collects a worker process' metrics for the parent to merge
+    global metrics
+    metrics = Metrics()
+    try:
+        return split(*args), metrics.snapshot()
+    finally:
+        metrics = None
+
+
+def merge_profiled(results):
+    for done, snapshot in results:
+        metrics.merge(snapshot)
+        yield done
+
+
+class HeaderIndex:
+    def __init__(self, path=':memory:'):
+        self._path = path
+        self._connection = sqlite3.connect(path)
+        columns = [row[1] for row in self._connection.execute(
+            'PRAGMA table_info(headers)')]
+        if columns and columns[6:] != list(INDEXED_KEYWORDS):
+            # written for other keywords, it is only a cache
+            self._connection.execute('DROP TABLE headers')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, '
+            'size INTEGER, mtime INTEGER, valid INTEGER, '
+            'TransferSyntaxUID TEXT, PixelDataOffset INTEGER, %s)'
+            % ', '.join('%s TEXT' % keyword for keyword in INDEXED_KEYWORDS))
+
+    @property
+    def path(self):
+        return self._path
+
+    def get(self, path, stat):
+        row = self._connection.execute(
+            'SELECT valid, TransferSyntaxUID, PixelDataOffset, %s FROM headers '
+            'WHERE path = ? AND size = ? AND mtime = ?'
+            % ', '.join(INDEXED_KEYWORDS),
+            (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is None:
+            return None
+        valid, transfer_syntax, offset, *values = row
+        if not valid:
+            return False
+        dataset = FileDataset(path, Dataset())
+        dataset.from_index = True
+        dataset.file_meta = pydicom.dataset.FileMetaDataset()
+        if transfer_syntax is not None:
+            dataset.file_meta.TransferSyntaxUID = transfer_syntax
+            dataset.is_little_endian = UID(transfer_syntax).is_little_endian
+            dataset.is_implicit_VR = UID(transfer_syntax).is_implicit_VR
+        dataset.pixel_data_offset = offset
+        for keyword, value in zip(INDEXED_KEYWORDS, values):
+            if value is not None:
+                if dictionary_VR(keyword) == 'US':
+                    value = int(value)
+                setattr(dataset, keyword, value)
+        return dataset
+
+    def put(self, path, stat, dataset=None, offset=None):
+        values = []
+        for keyword in INDEXED_KEYWORDS:
+            value = None if dataset is None else dataset.get(keyword)
+            if isinstance(value, MultiValue):
+                value = '\\'.join(map(str, value))
+            elif value is not None:
+                value = str(value)
+            values.append(value)
+        if dataset is None:
+            transfer_syntax = None
+        else:
+            transfer_syntax = dataset.file_meta.get('TransferSyntaxUID')
+        self._connection.execute(
+            'INSERT OR REPLACE INTO headers VALUES (%s)'
+            % ', '.join('?' * (6 + len(INDEXED_KEYWORDS))),
+            [os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+             dataset is not None, transfer_syntax, offset] + values)
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
 
 
 class DICOMDirectory:
-    def __init__(self, directory=None):
+    def __init__(self, directory=None, stop_before_pixels=False, entries=None,
+                 index=None, dicomdir=None):
+        # dicomdir is the (images, others) keys of the DICOMDIRs read so far,
+        # shared by the caller so one DICOMDIR covers its subdirectories
         self._directory = directory
+        self._stop_before_pixels = stop_before_pixels
+        self._entries = entries
+        self._index = index
+        self._dicomdir = (set(), set()) if dicomdir is None else dicomdir
 
     @property
     def directory(self):
@@ -26,27 +254,99 @@ class DICOMDirectory:
     @directory.setter
     def directory(self, directory):
         self._directory = directory
+        self._entries = None
+
+    @property
+    def stop_before_pixels(self):
+        return self._stop_before_pixels
+
+    @stop_before_pixels.setter
+    def stop_before_pixels(self, stop_before_pixels):
+        self._stop_before_pixels = stop_before_pixels
+
+    @property
+    def index(self):
+        return self._index
+
+    @index.setter
+    def index(self, index):
+        self._index = index
+
+    def candidates(self):
+        entries = self._entries
+        if entries is None:
+            with os.scandir(self._directory) as scanned:
+                entries = [entry for entry in scanned if entry.is_file()]
+        images, others = self._dicomdir
+        for entry in entries:
+            if entry.name.upper() == DICOMDIR:
+                found_images, found_others = read_dicomdir(entry.path)
+                images |= found_images
+                others |= found_others
+                others -= images
+        for entry in entries:
+            key = dicomdir_key(entry.path)
+            if entry.name.upper() == DICOMDIR or key in others:
+                continue
+            yield entry, key in images
 
     def __iter__(self):
         if self._directory is None:
-            self.filenames = []
+            self._candidates = iter(())
         else:
-            self.filenames = os.listdir(self._directory)
+            self._candidates = self.candidates()
         return self
 
     def __next__(self):
-        while self.filenames:
-            filename = self.filenames.pop(0)
-            path = os.path.join(self._directory, filename)
+        # the index only holds headers
+        index = self._index if self._stop_before_pixels else None
+        for entry, listed in self._candidates:
+            filename, path = entry.name, entry.path
+            if index is not None:
+                stat = entry.stat()
+                dataset = index.get(path, stat)
+                if dataset is not None:
+                    if dataset is False:
+                        warnings.warn('%s is not a valid DICOM file' % filename)
+                        count('files_skipped')
+                        continue
+                    return path, dataset
+            # instances listed in the DICOMDIR are trusted, anything else
+            # has to carry the DICM prefix before it is parsed
+            if not listed and not is_dicom_file(path):
+                warnings.warn('%s is not a valid DICOM file' % filename)
+                count('files_skipped')
+                if index is not None:
+                    index.put(path, stat)
+                continue
             try:
-                dataset = pydicom.dcmread(path)
+                with open(path, 'rb') as fp:
+                    with timed('scan'):
+                        dataset = pydicom.dcmread(
+                            fp, stop_before_pixels=self._stop_before_pixels)
+                    if self._stop_before_pixels and 'SOPInstanceUID' in dataset:
+                        located = pixel_data_offset(fp, dataset)
+                        offset, length = (None, None) if located is None else located
+                        # an in-process split maps the pixels from here
+                        dataset.pixel_data_offset = offset
+                        dataset.pixel_data_length = length
             except pydicom.errors.InvalidDicomError:
                 warnings.warn('%s is not a valid DICOM file' % filename)
+                count('files_skipped')
+                if index is not None:
+                    index.put(path, stat)
                 continue
             if not hasattr(dataset, 'SOPInstanceUID'):
                 warnings.warn('%s is not a valid DICOM file' % filename)
+                count('files_skipped')
+                if index is not None:
+                    index.put(path, stat)
                 continue
+            if index is not None:
+                index.put(path, stat, dataset, offset)
             return path, dataset
+        if index is not None:
+            index.commit()
         raise StopIteration
 
 class DICOMSplitterTB:
@@ -98,74 +398,80 @@ class DICOMSplitterTB:
     def offset(self, offset):
         self._offset = offset
 
+    @property
+    def parameters(self):
+        return self._axis, self._nT, self._nB, self._offset
+
+    @property
+    def columns(self):
+        return self._nT, self._nB
+
+    @property
+    def boxes(self):
+        if self._pixel_array is None:
+            return None
+        return crop_plan(self, self._pixel_array.shape)
+
+    def crop_boxes(self, shape, messages=None):
+        # assume only 2 row for now
+        sizeC = shape[1]
+        sizeR = shape[0]
+        offsetInPx = math.floor(self._offset / 100 * sizeR)
+        sizeTC = int(math.floor(sizeC/self._nT))
+        sizeBC = int(math.floor(sizeC/self._nB))
+        sizeR = int(math.floor(sizeR/2)) - offsetInPx
+        remainderR = shape[0] % 2
+        boxes = []
+        # 1 is column 0 is row
+        for index in range(self._nTotal):
+            start = numpy.zeros(len(shape), numpy.int16)
+            stop = numpy.array(shape, numpy.int16)
+            # at top bed
+            if int(math.floor(index / self._nT)) == 0:
+                remainderC = shape[1] % self._nT
+                offsetC = max(0, index + 1 + remainderC - self._nT)
+                offsetR = max(0, index + 1 + remainderR - 2)
+                if offsetC:
+                    non_divisible(messages, 'image axis %d not divisible by %d'
+                                            ', split %d offset 1 pixel from previous split'
+                                            % (self._axis, self._nT, index + 1))
+                start[1] = index % self._nT * sizeTC + offsetC
+                stop[1] = start[1] + sizeTC
+                start[0] = offsetR
+                stop[0] = start[0] + sizeR
+            else:
+                remainderC = shape[1] % self._nB
+                offsetC = max(0, (index - self._nT) + 1 + remainderC - self._nB)
+                offsetR = max(0, (index - self._nT) + 1 + remainderR - 2)
+                if offsetC:
+                    non_divisible(messages, 'image axis %d not divisible by %d'
+                                            ', split %d offset 1 pixel from previous split'
+                                            % (self._axis, self._nB, index + 1))
+                start[1] = (index - self._nT) % self._nB * sizeBC + offsetC
+                stop[1] = start[1] + sizeBC
+                start[0] = sizeR + offsetR
+                stop[0] = start[0] + sizeR + 2 * offsetInPx
+            boxes.append((start, stop))
+        return boxes
+
     def __iter__(self):
         self.index = 0
         if self._pixel_array is not None:
-            # assume only 2 row for now
-            sizeC = self._pixel_array.shape[1]
-            sizeR = self._pixel_array.shape[0]
-            self._offsetInPx = math.floor(self._offset / 100 * sizeR)
-            self.sizeTC = int(math.floor(sizeC/self._nT))
-            self.sizeBC = int(math.floor(sizeC/self._nB))
-            self.sizeR = int(math.floor(sizeR/2)) - self._offsetInPx
+            self._boxes = self.boxes
         return self
 
     def __next__(self):
         if self.index == self._nTotal:
             raise StopIteration
         index = self.index
+        self.index += 1
 
         if self._pixel_array is None:
-            self.index += 1
             return index, None, None
 
-        start = numpy.zeros(self._pixel_array.ndim, numpy.int16)
-        # 1 is column 0 is row
-        # at top bed
-        if int(math.floor(self.index / self._nT)) == 0:
-            # pass
-            # print('iterate on top bed')
-            remainderC = self._pixel_array.shape[1] % self._nT
-            offsetC = max(0, index + 1 + remainderC - self._nT)
-            remainderR = self._pixel_array.shape[0] % 2
-            offsetR = max(0, index + 1 + remainderR - 2)
-            if offsetC:
-                warnings.warn('image axis %d not divisible by %d'
-                              ', split %d offset 1 pixel from previous split'
-                              % (self._axis, self._n, index + 1))
-            start[1] = index % self._nT * self.sizeTC + offsetC
-            stop = numpy.zeros(self._pixel_array.ndim, numpy.int16)
-            stop[1] = start[1] + self.sizeTC
-
-            start[0] = int(math.floor(self.index / self._nT)) * self.sizeR + offsetR
-            stop[0] = start[0] + self.sizeR
-            indicesC = numpy.arange(start[1], stop[1])
-            indicesR = numpy.arange(start[0], stop[0])
-        else:
-            # print('iterate on bottom bed')
-            remainderC = self._pixel_array.shape[1] % self._nB
-            offsetC = max(0, (index - self._nT) + 1 + remainderC - self._nB)
-            remainderR = self._pixel_array.shape[0] % 2
-            offsetR = max(0, (index - self._nT) + 1 + remainderR - 2)
-            if offsetC:
-                warnings.warn('image axis %d not divisible by %d'
-                              ', split %d offset 1 pixel from previous split'
-                              % (self._axis, self._nB, index + 1))
-            start[1] = (index - self._nT) % self._nB * self.sizeBC + offsetC
-            stop = numpy.zeros(self._pixel_array.ndim, numpy.int16)
-            stop[1] = start[1] + self.sizeBC
-
-            # assume only 2 row for now
-            start[0] = self.sizeR + offsetR
-            stop[0] = start[0] + self.sizeR + 2 * self._offsetInPx
-            indicesC = numpy.arange(start[1], stop[1])
-            indicesR = numpy.arange(start[0], stop[0])
-        self.index += 1
-        # print ('start and stop')
-        # print (start,stop)
-        # print (start[0],start[0]+len(indicesR))
-        # print (start[1],start[1]+len(indicesC))
-        return index, start, self._pixel_array[start[0]:stop[0],start[1]:stop[1]]
+        start, stop = self._boxes[index]
+        # basic slicing, the split is a view on the original pixels
+        return index, start, self._pixel_array[tuple(map(slice, start, stop))]
 
 class DICOMSplitter:
     def __init__(self, pixel_array=None, axis=0, n=2):
@@ -197,46 +503,738 @@ class DICOMSplitter:
     def n(self, n):
         self._n = n
 
+    @property
+    def parameters(self):
+        return self._axis, self._n
+
+    @property
+    def columns(self):
+        # cells per row, top to bottom
+        return (self._n,) if self._axis == 1 else (1,) * self._n
+
+    @property
+    def boxes(self):
+        if self._pixel_array is None:
+            return None
+        return crop_plan(self, self._pixel_array.shape)
+
+    def crop_boxes(self, shape, messages=None):
+        size = int(math.floor(shape[self._axis]/self._n))
+        remainder = shape[self._axis] % self._n
+        boxes = []
+        for index in range(self._n):
+            offset = max(0, index + 1 + remainder - self._n)
+            if offset:
+                non_divisible(messages, 'image axis %d not divisible by %d'
+                                        ', split %d offset 1 pixel from previous split'
+                                        % (self._axis, self._n, index + 1))
+            start = numpy.zeros(len(shape), numpy.int16)
+            stop = numpy.array(shape, numpy.int16)
+            start[self._axis] = index * size + offset
+            stop[self._axis] = start[self._axis] + size
+            boxes.append((start, stop))
+        return boxes
+
     def __iter__(self):
         self.index = 0
         if self._pixel_array is not None:
-            size = self._pixel_array.shape[self._axis]
-            self.size = int(math.floor(size/self._n))
+            self._boxes = self.boxes
         return self
 
     def __next__(self):
         if self.index == self._n:
             raise StopIteration
-
         index = self.index
+        self.index += 1
+
+        if self._pixel_array is None:
+            return index, None, None
+
+        start, stop = self._boxes[index]
+        # basic slicing, the split is a view on the original pixels
+        return index, start, self._pixel_array[tuple(map(slice, start, stop))]
+
+class DICOMSplitterGrid:
+    def __init__(self, pixel_array=None, columns=(2,), offsets=None, masks=None):
+        # columns per row, top to bottom; offsets move the top edge of each
+        # row up by a percentage of the rows; masked cells are never cropped
+        self._pixel_array = pixel_array
+        self._columns = tuple(columns)
+        self._offsets = tuple(offsets) if offsets else (0,) * len(self._columns)
+        self._nTotal = sum(self._columns)
+        self._masks = tuple(masks) if masks else (False,) * self._nTotal
+        if len(self._offsets) != len(self._columns):
+            raise ValueError('one offset per row')
+        if len(self._masks) != self._nTotal:
+            raise ValueError('one mask per cell')
+
+    @property
+    def pixel_array(self):
+        return self._pixel_array
+
+    @pixel_array.setter
+    def pixel_array(self, pixel_array):
+        self._pixel_array = pixel_array
+
+    @property
+    def columns(self):
+        return self._columns
 
+    @property
+    def offsets(self):
+        return self._offsets
+
+    @property
+    def masks(self):
+        return self._masks
+
+    @masks.setter
+    def masks(self, masks):
+        self._masks = tuple(masks)
+
+    @property
+    def parameters(self):
+        return self._columns, self._offsets
+
+    @property
+    def boxes(self):
         if self._pixel_array is None:
+            return None
+        return crop_plan(self, self._pixel_array.shape)
+
+    def crop_boxes(self, shape, messages=None):
+        nR = len(self._columns)
+        sizeR = int(math.floor(shape[0]/nR))
+        remainderR = shape[0] % nR
+        offsetsInPx = [math.floor(offset / 100 * shape[0]) for offset in self._offsets] + [0]
+        boxes = []
+        for row, nC in enumerate(self._columns):
+            offsetR = max(0, row + 1 + remainderR - nR)
+            if offsetR:
+                non_divisible(messages, 'image axis 0 not divisible by %d'
+                                        ', row %d offset 1 pixel from previous row'
+                                        % (nR, row + 1))
+            sizeC = int(math.floor(shape[1]/nC))
+            remainderC = shape[1] % nC
+            for column in range(nC):
+                offsetC = max(0, column + 1 + remainderC - nC)
+                if offsetC:
+                    non_divisible(messages, 'image axis 1 not divisible by %d'
+                                            ', split %d offset 1 pixel from previous split'
+                                            % (nC, len(boxes) + 1))
+                start = numpy.zeros(len(shape), numpy.int16)
+                stop = numpy.array(shape, numpy.int16)
+                start[0] = max(0, row * sizeR + offsetR - offsetsInPx[row])
+                stop[0] = min(shape[0], (row + 1) * sizeR + offsetR - offsetsInPx[row + 1])
+                start[1] = column * sizeC + offsetC
+                stop[1] = start[1] + sizeC
+                boxes.append((start, stop))
+        return boxes
+
+    def __iter__(self):
+        self.index = 0
+        if self._pixel_array is not None:
+            self._boxes = self.boxes
+        return self
+
+    def __next__(self):
+        while self.index < self._nTotal and self._masks[self.index]:
             self.index += 1
+        if self.index == self._nTotal:
+            raise StopIteration
+        index = self.index
+        self.index += 1
+
+        if self._pixel_array is None:
             return index, None, None
 
-        start = numpy.zeros(self._pixel_array.ndim, numpy.int16)
-        remainder = self._pixel_array.shape[self._axis] % self._n
-        offset = max(0, index + 1 + remainder - self._n)
-        if offset:
-            warnings.warn('image axis %d not divisible by %d'
-                          ', split %d offset 1 pixel from previous split'
-                          % (self._axis, self._n, index + 1))
-        start[self._axis] = index * self.size + offset
-        stop = numpy.zeros(self._pixel_array.ndim, numpy.int16)
-        stop[self._axis] = start[self._axis] + self.size
-        indices = numpy.arange(start[self._axis], stop[self._axis])
+        start, stop = self._boxes[index]
+        # basic slicing, the split is a view on the original pixels
+        return index, start, self._pixel_array[tuple(map(slice, start, stop))]
+
+
+class DICOMSplitterBoxes:
+    def __init__(self, pixel_array=None, boxes=(), masks=None):
+        # explicit ((row start, column start), (row stop, column stop)) per
+        # cell, e.g. from --auto; masked cells are never cropped
+        self._pixel_array = pixel_array
+        self._boxes = tuple(boxes)
+        self._nTotal = len(self._boxes)
+        self._masks = tuple(masks) if masks else (False,) * self._nTotal
+        if len(self._masks) != self._nTotal:
+            raise ValueError('one mask per cell')
+
+    @property
+    def pixel_array(self):
+        return self._pixel_array
+
+    @pixel_array.setter
+    def pixel_array(self, pixel_array):
+        self._pixel_array = pixel_array
+
+    @property
+    def masks(self):
+        return self._masks
+
+    @property
+    def parameters(self):
+        return (self._boxes,)
+
+    @property
+    def boxes(self):
+        if self._pixel_array is None:
+            return None
+        return crop_plan(self, self._pixel_array.shape)
+
+    def crop_boxes(self, shape, messages=None):
+        boxes = []
+        for box_start, box_stop in self._boxes:
+            start = numpy.zeros(len(shape), numpy.int16)
+            stop = numpy.array(shape, numpy.int16)
+            start[:2] = numpy.minimum(box_start, shape[:2])
+            stop[:2] = numpy.minimum(box_stop, shape[:2])
+            boxes.append((start, stop))
+        return boxes
+
+    def __iter__(self):
+        self.index = 0
+        if self._pixel_array is not None:
+            self._crops = self.boxes
+        return self
+
+    def __next__(self):
+        while self.index < self._nTotal and self._masks[self.index]:
+            self.index += 1
+        if self.index == self._nTotal:
+            raise StopIteration
+        index = self.index
         self.index += 1
-        # print(self.index)
-        # print(start)
-        # print(indices)
-        # print(numpy.take(self._pixel_array, indices, self._axis).shape)
-        return index, start, numpy.take(self._pixel_array, indices, self._axis)
+
+        if self._pixel_array is None:
+            return index, None, None
+
+        start, stop = self._crops[index]
+        # basic slicing, the split is a view on the original pixels
+        return index, start, self._pixel_array[tuple(map(slice, start, stop))]
+
+
+def non_divisible(messages, message, uses=1):
+    # collected by the cached crop plan, warned on every use of it
+    if messages is None:
+        count('warnings_non_divisible_axis', uses)
+        warnings.warn(message)
+    else:
+        messages.append(message)
+
+
+@functools.lru_cache(maxsize=64)
+def _crop_plan(splitter_type, parameters, shape):
+    messages = []
+    boxes = splitter_type(None, *parameters).crop_boxes(shape, messages)
+    # shared by every slice of the geometry
+    for start, stop in boxes:
+        start.setflags(write=False)
+        stop.setflags(write=False)
+    return boxes, tuple(messages)
+
+
+def crop_plan(splitter, shape, uses=1):
+    # the crop boxes only depend on the layout and the image shape, compute
+    # them once per geometry instead of once per slice; uses is the number
+    # of slices cropped with them
+    boxes, messages = _crop_plan(type(splitter), splitter.parameters, tuple(shape))
+    for message in messages:
+        non_divisible(None, message, uses)
+    return boxes
+
+
+# a row or column of a MIP is occupied, and a slot is not empty, when more
+# than this fraction of its pixels is above the --auto threshold
+AUTO_OCCUPIED = 0.01
+
+
+def content_mask(mip, threshold=0.1):
+    # threshold of the way from the background to the brightest pixels,
+    # percentiles so that a few hot pixels do not move it
+    low, high = numpy.percentile(mip, (1, 99.9))
+    return mip > low + threshold * (high - low)
+
+
+def gap_cut(occupied, cut, window):
+    # the centre of the widest empty run within window lines of cut, the
+    # nearest of equally wide ones; cut itself when there is none
+    lo, hi = max(0, cut - window), min(len(occupied), cut + window + 1)
+    empty = numpy.flatnonzero(~occupied[lo:hi]) + lo
+    if not len(empty):
+        return cut
+    runs = numpy.split(empty, numpy.flatnonzero(numpy.diff(empty) != 1) + 1)
+    run = min(runs, key=lambda run: (-len(run), abs((run[0] + run[-1] + 1) // 2 - cut)))
+    return int((run[0] + run[-1] + 1) // 2)
+
+
+def auto_boxes(mip, dicom_splitter, threshold=0.1):
+    # the splitter's cuts moved into the gaps of the MIP's row profile, then
+    # of each row band's column profile; slots without content are masked
+    content = content_mask(mip, threshold)
+    boxes = crop_plan(dicom_splitter, mip.shape)
+    columns = dicom_splitter.columns
+    first = numpy.cumsum((0,) + tuple(columns))
+    occupied = content.mean(axis=1) > AUTO_OCCUPIED
+    bands = [0]
+    for row in range(1, len(columns)):
+        cut = int(boxes[first[row]][0][0])
+        bands.append(gap_cut(occupied, cut, (cut - bands[-1]) // 2))
+    bands.append(mip.shape[0])
+    cells, masks = [], []
+    for row, nC in enumerate(columns):
+        band = content[bands[row]:bands[row + 1]]
+        occupied = band.mean(axis=0) > AUTO_OCCUPIED
+        cuts = [0]
+        for column in range(1, nC):
+            cut = int(boxes[first[row] + column][0][1])
+            cuts.append(gap_cut(occupied, cut, (cut - cuts[-1]) // 2))
+        cuts.append(mip.shape[1])
+        for column in range(nC):
+            cells.append(((bands[row], cuts[column]), (bands[row + 1], cuts[column + 1])))
+            masks.append(bool(band[:, cuts[column]:cuts[column + 1]].mean() <= AUTO_OCCUPIED))
+    return tuple(cells), tuple(masks)
+
+
+def series_mip(headers):
+    # running maximum over the series, one slice (or file of frames) at a
+    # time, (path, dataset) pairs from the header index are not parsed
+    mip = None
+    for path, dataset in headers:
+        pixel_array = map_indexed_pixel_array(path, dataset)
+        if pixel_array is None:
+            dataset, pixel_array = read_pixel_array(path)
+        if pixel_array is None:
+            continue
+        if is_multi_frame(dataset, pixel_array):
+            pixel_array = pixel_array.max(axis=0)
+        if pixel_array.ndim == 3:
+            # colour, the brightest sample
+            pixel_array = pixel_array.max(axis=-1)
+        if mip is None:
+            mip = numpy.array(pixel_array)
+        elif mip.shape == pixel_array.shape:
+            numpy.maximum(mip, pixel_array, out=mip)
+    return mip
+
+
+def series_mips(headers):
+    # series key -> MIP, for --auto and --trim
+    series = collections.OrderedDict()
+    for _, path, dataset in headers:
+        series.setdefault(series_key(dataset), []).append((path, dataset))
+    mips = collections.OrderedDict()
+    for key, series_headers in series.items():
+        with timed('mip'):
+            mip = series_mip(series_headers)
+        if mip is not None:
+            mips[key] = mip
+    return mips
+
+
+def layout_boxes(layouts, key, dicom_splitter, order, shape):
+    # the (order, (boxes, masks)) of a series: its own layout, else the
+    # splitter's boxes masked by order
+    series_order, boxes = layouts.get(key, (order, None))
+    if boxes is None:
+        boxes = (tuple((tuple(map(int, start[:2])), tuple(map(int, stop[:2])))
+                       for start, stop in crop_plan(dicom_splitter, shape)),
+                 tuple(int(o) == 0 for o in series_order))
+    return series_order, boxes
+
+
+def auto_layouts(mips, dicom_splitter, threshold=0.1):
+    # series key -> (order, (boxes, masks)) laid out from the series' MIP
+    layouts = {}
+    for key, mip in mips.items():
+        with timed('auto_layout'):
+            boxes, masks = auto_boxes(mip, dicom_splitter, threshold)
+        if all(masks):
+            count('warnings_auto_empty')
+            warnings.warn('no subject found in series %s' % key[0])
+        layouts[key] = (['0' if masked else '1' for masked in masks], (boxes, masks))
+    return layouts
+
+
+def trim_boxes(mip, boxes, threshold=0.1, margin=10):
+    # each box shrunk to the bounding box of its content over the whole
+    # series plus margin pixels; a box without content is left as it is
+    content = content_mask(mip, threshold)
+    trimmed = []
+    for (r0, c0), (r1, c1) in boxes:
+        cell = content[r0:r1, c0:c1]
+        rows = numpy.flatnonzero(cell.mean(axis=1) > AUTO_OCCUPIED) if cell.size else ()
+        columns = numpy.flatnonzero(cell.mean(axis=0) > AUTO_OCCUPIED) if cell.size else ()
+        if not len(rows) or not len(columns):
+            trimmed.append(((r0, c0), (r1, c1)))
+            continue
+        trimmed.append(((max(r0, r0 + int(rows[0]) - margin),
+                         max(c0, c0 + int(columns[0]) - margin)),
+                        (min(r1, r0 + int(rows[-1]) + 1 + margin),
+                         min(c1, c0 + int(columns[-1]) + 1 + margin))))
+    return tuple(trimmed)
+
+
+def trimmed_layouts(mips, dicom_splitter, order, layouts, threshold=0.1, margin=10):
+    # series key -> (order, (boxes, masks)) with every box cropped to content
+    trimmed = dict(layouts)
+    for key, mip in mips.items():
+        with timed('trim'):
+            series_order, (boxes, masks) = layout_boxes(layouts, key, dicom_splitter,
+                                                        order, mip.shape)
+            trimmed[key] = (series_order,
+                            (trim_boxes(mip, boxes, threshold, margin), masks))
+    return trimmed
+
+
+def patient_boxes(boxes, affine_matrix):
+    # the pixel edge corners of each box in patient coordinates
+    return tuple(tuple(tuple(affine_matrix.dot([r - 0.5, c - 0.5, 0, 1])[:3])
+                       for r, c in box) for box in boxes)
+
+
+def pixel_boxes(corners, affine_matrix, shape):
+    # patient coordinates back to the pixel edges of another series,
+    # projected on its image plane; adjacent boxes keep sharing their edges
+    corners = numpy.array(corners, numpy.float64).reshape(-1, 3)
+    edges = numpy.linalg.lstsq(affine_matrix[:3, :2],
+                               (corners - affine_matrix[:3, 3]).T, rcond=None)[0]
+    edges = numpy.rint(edges.T + 0.5).reshape(-1, 2, 2)
+    starts = numpy.clip(edges.min(axis=1), 0, shape).astype(int)
+    stops = numpy.clip(edges.max(axis=1), 0, shape).astype(int)
+    return tuple((tuple(map(int, start)), tuple(map(int, stop)))
+                 for start, stop in zip(starts, stops))
+
+
+def is_reference(dataset, reference):
+    return reference in (dataset.get('Modality'), dataset.get('SeriesInstanceUID'))
+
+
+def shared_layouts(headers, dicom_splitter, order, layouts, reference='CT'):
+    # series key -> (order, (boxes, masks)): the boxes of the study's
+    # reference series (a Modality or SeriesInstanceUID), mapped through
+    # patient coordinates into every other series of the same study
+    studies = collections.OrderedDict()
+    for _, _, dataset in headers:
+        studies.setdefault(dataset.get('StudyInstanceUID'), collections.OrderedDict()) \
+            .setdefault(series_key(dataset), dataset)
+    shared = dict(layouts)
+    for study_instance_uid, series in studies.items():
+        references = [key for key, dataset in series.items()
+                      if has_geometry(dataset) and is_reference(dataset, reference)]
+        if not references:
+            count('warnings_no_reference')
+            warnings.warn('no %s reference series in study %s, its series are'
+                          ' split on their own' % (reference, study_instance_uid))
+            continue
+        reference_key = references[0]
+        reference_dataset = series[reference_key]
+        reference_order, (boxes, masks) = layout_boxes(
+            layouts, reference_key, dicom_splitter, order,
+            (reference_dataset.Rows, reference_dataset.Columns))
+        with timed('shared_layout'):
+            corners = patient_boxes(boxes, affine(reference_dataset))
+            for key, dataset in series.items():
+                if key == reference_key:
+                    shared[key] = (reference_order, (boxes, masks))
+                elif has_geometry(dataset):
+                    mapped = pixel_boxes(corners, affine(dataset),
+                                         (dataset.Rows, dataset.Columns))
+                    # a subject outside this series' field of view
+                    mapped_masks = tuple(masked or start[0] >= stop[0] or start[1] >= stop[1]
+                                         for masked, (start, stop) in zip(masks, mapped))
+                    shared[key] = (reference_order, (mapped, mapped_masks))
+                else:
+                    count('warnings_no_geometry')
+                    warnings.warn('series %s has no geometry, it is split on its'
+                                  ' own' % key[0])
+    return shared
+
+
+class SeriesCache:
+    def __init__(self, maxsize=128):
+        self._maxsize = maxsize
+        self._cache = collections.OrderedDict()
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        self._maxsize = maxsize
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key, factory):
+        try:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        except KeyError:
+            pass
+        value = self._cache[key] = factory()
+        while len(self._cache) > self._maxsize:
+            self._cache.popitem(last=False)
+        return value
+
+
+class Manifest:
+    def __init__(self, path):
+        self._path = path
+        self._done = set()
+        if os.path.exists(path):
+            with open(path) as fp:
+                for line in fp:
+                    fields = line.split()
+                    # a line cut short by a crash is ignored
+                    if len(fields) == 2 and fields[1].isdigit():
+                        self._done.add((fields[0], int(fields[1])))
+        self._fp = open(path, 'a')
+
+    @property
+    def path(self):
+        return self._path
+
+    def __contains__(self, pair):
+        return pair in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def skip(self, source_instance_uid, n):
+        return frozenset(i for i in range(n)
+                         if (source_instance_uid, i) in self._done)
+
+    def update(self, pairs):
+        for source_instance_uid, i in pairs:
+            self._done.add((source_instance_uid, i))
+            self._fp.write('%s %d\n' % (source_instance_uid, i))
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+def archive_valid(path, format):
+    # a zip without its central directory would get a second archive
+    # appended, a tar without its end blocks can not be appended to
+    if format == 'zip':
+        return zipfile.is_zipfile(path)
+    try:
+        with tarfile.open(path, 'a'):
+            return True
+    except tarfile.ReadError:
+        return False
+
+
+def repair_tar(path):
+    end = 0
+    with open(path, 'r+b') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        try:
+            with tarfile.open(fileobj=fp, mode='r') as archive:
+                for info in archive:
+                    blocks = -(-info.size // tarfile.BLOCKSIZE)
+                    stop = info.offset_data + blocks * tarfile.BLOCKSIZE
+                    if stop > size:
+                        break
+                    end = stop
+        except tarfile.ReadError:
+            pass
+        fp.seek(end)
+        fp.truncate()
+        fp.write(tarfile.NUL * 2 * tarfile.BLOCKSIZE)
+
+
+def repair_zip(path):
+    # members are stored with their sizes in the local headers, copy the
+    # complete ones into a new archive
+    with open(path, 'rb') as fp, zipfile.ZipFile(path + '.repair', 'w') as archive:
+        while True:
+            header = fp.read(zipfile.sizeFileHeader)
+            if len(header) < zipfile.sizeFileHeader or \
+                    header[:4] != zipfile.stringFileHeader:
+                break
+            fields = struct.unpack(zipfile.structFileHeader, header)
+            flags, compress_type, dostime, dosdate = fields[3:7]
+            size, name_length, extra_length = fields[8], fields[10], fields[11]
+            if flags & 0x08 or compress_type != zipfile.ZIP_STORED:
+                break
+            name = fp.read(name_length)
+            fp.seek(extra_length, os.SEEK_CUR)
+            data = fp.read(size)
+            if len(data) < size:
+                break
+            date_time = ((dosdate >> 9) + 1980, (dosdate >> 5) & 0xF, dosdate & 0x1F,
+                         dostime >> 11, (dostime >> 5) & 0x3F, (dostime & 0x1F) * 2)
+            encoding = 'utf-8' if flags & 0x800 else 'cp437'
+            archive.writestr(zipfile.ZipInfo(name.decode(encoding), date_time), data)
+    os.replace(path + '.repair', path)
+
+
+def repair_archive(path, format):
+    if format == 'tar':
+        repair_tar(path)
+    else:
+        repair_zip(path)
+
+
+class SplitArchive:
+    def __init__(self, format='tar', path=None, root=None, buffer_size=2 ** 20):
+        # one archive per subject directory, or everything in path with
+        # member names relative to root
+        if format not in ARCHIVE_FORMATS:
+            raise ValueError('unknown archive format %s' % format)
+        self._format = format
+        self._path = path
+        self._root = root
+        self._buffer_size = buffer_size
+        self._archives = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def format(self):
+        return self._format
+
+    @property
+    def path(self):
+        return self._path
+
+    def _open(self, path):
+        # appends to an archive left by an earlier (resumed) run, one cut
+        # short by a kill first loses the member it was writing
+        exists = os.path.exists(path)
+        if exists and not archive_valid(path, self._format):
+            warnings.warn('%s is damaged, keeping only its complete members' % path)
+            count('warnings_archive_repaired')
+            repair_archive(path, self._format)
+        fp = open(path, 'r+b' if exists else 'wb', buffering=self._buffer_size)
+        mode = 'a' if exists else 'w'
+        try:
+            if self._format == 'tar':
+                archive = tarfile.open(fileobj=fp, mode=mode)
+            else:
+                archive = zipfile.ZipFile(fp, mode)
+        except BaseException:
+            fp.close()
+            raise
+        if self._format == 'tar':
+            names = set(archive.getnames())
+        else:
+            names = set(archive.namelist())
+        return archive, fp, names
+
+    def add(self, subject, filename, data):
+        if self._path is None:
+            path = subject.rstrip(os.sep) + '.' + self._format
+            name = os.path.basename(subject.rstrip(os.sep))
+        else:
+            path = self._path
+            name = os.path.relpath(subject, self._root)
+        name = '/'.join(name.split(os.sep) + [filename])
+        with self._lock:
+            try:
+                archive, fp, names = self._archives[path]
+            except KeyError:
+                archive, fp, names = self._archives[path] = self._open(path)
+            # already there when the manifest lagged behind the archive
+            if name in names:
+                return path
+            names.add(name)
+            if self._format == 'tar':
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = time.time()
+                archive.addfile(info, io.BytesIO(data))
+            else:
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                archive.writestr(info, data)
+        return path
+
+    def flush(self):
+        with self._lock:
+            for _, fp, _ in self._archives.values():
+                fp.flush()
+
+    def close(self):
+        with self._lock:
+            while self._archives:
+                _, (archive, fp, _) = self._archives.popitem(last=False)
+                archive.close()
+                fp.close()
+
+
+class MemoryBudget:
+    def __init__(self, limit):
+        self._limit = limit
+        self._used = 0
+        self._ticket = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def used(self):
+        return self._used
+
+    def acquire(self, nbytes, block=True, ticket=None):
+        # tickets are admitted in order, so a later item can never hold the
+        # budget an earlier one is waiting for
+        with self._condition:
+            # a single item larger than the budget is still let through
+            while not self._closed and \
+                    ((ticket is not None and ticket != self._ticket) or
+                     (block and self._used and self._used + nbytes > self._limit)):
+                self._condition.wait()
+            self._used += nbytes
+            if ticket is not None:
+                self._ticket += 1
+                self._condition.notify_all()
+
+    def release(self, nbytes):
+        with self._condition:
+            self._used -= nbytes
+            self._condition.notify_all()
+
+    def close(self):
+        # lets every waiting reader through so the pools can shut down
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+# boxes are the (boxes, masks) of an --auto layout
+Series = collections.namedtuple('Series', ['patient', 'study_instance_uids',
+                                           'series_instance_uids',
+                                           'affine_matrix', 'namespace',
+                                           'boxes'], defaults=(None,))
 
 
 def x667_uuid():
     return '2.25.%d' % uuid.uuid4()
 
 
+def make_uid_namespace(name=None):
+    if isinstance(name, uuid.UUID):
+        # already made, e.g. once for a long running node or daemon
+        return name
+    if name is None:
+        return uuid.uuid4()
+    return uuid.uuid5(uuid.NAMESPACE_OID, name)
+
+
+def derived_uid(namespace, *names):
+    return '2.25.%d' % uuid.uuid5(namespace, '/'.join(map(str, names))).int
+
+
 def parse_patient(patient, delimiter='_'):
     root, *ids = str(patient).split(delimiter)
     trailing = ''
@@ -276,6 +1274,47 @@ def affine(dataset):
                         [0, 0, 0, 1]])
 
 
+def has_geometry(dataset):
+    return 'ImageOrientationPatient' in dataset and 'PixelSpacing' in dataset \
+        and 'ImagePositionPatient' in dataset
+
+
+def functional_group(dataset, frame, sequence):
+    # the frame's own functional group, else the shared one
+    for groups, item in (('PerFrameFunctionalGroupsSequence', frame),
+                         ('SharedFunctionalGroupsSequence', 0)):
+        groups = dataset.get(groups)
+        if groups and len(groups) > item and groups[item].get(sequence):
+            return groups[item].get(sequence)[0]
+    return None
+
+
+def update_frame_positions(split_dataset, origin):
+    # enhanced multi-frame: every frame has its own plane position, moved by
+    # the same crop origin along its own orientation and spacing
+    updated = set()
+    for frame in range(len(split_dataset.get('PerFrameFunctionalGroupsSequence') or ())):
+        position = functional_group(split_dataset, frame, 'PlanePositionSequence')
+        orientation = functional_group(split_dataset, frame, 'PlaneOrientationSequence')
+        measures = functional_group(split_dataset, frame, 'PixelMeasuresSequence')
+        # a shared plane position is moved once only
+        if position is None or orientation is None or measures is None or \
+                id(position) in updated:
+            continue
+        values = (position.get('ImagePositionPatient'),
+                  orientation.get('ImageOrientationPatient'),
+                  measures.get('PixelSpacing'))
+        if any(value is None for value in values):
+            continue
+        geometry = Dataset()
+        geometry.ImagePositionPatient, geometry.ImageOrientationPatient, \
+            geometry.PixelSpacing = values
+        frame_position = affine(geometry).dot(numpy.append(origin, [0, 1]))
+        # maximum 16 characters
+        position.ImagePositionPatient = [str(p)[:16] for p in frame_position[:3]]
+        updated.add(id(position))
+
+
 def directory_name(directory, i):
     return os.path.join(directory.rstrip(os.sep), i)
 
@@ -334,7 +1373,7 @@ def get_patient_TB(patient_name, patient_id, n, patient_names=None, patient_ids=
         # patient_ids, id_trailing = parse_patient(patient_id)
     # print(patient_names)
     if len(patient_names) != n:
-        tmpName = 3 * ['blank']
+        tmpName = n * ['blank']
         for i in range(len(order)):
             if int(order[i]) != 0:
                 try:
@@ -342,9 +1381,10 @@ def get_patient_TB(patient_name, patient_id, n, patient_names=None, patient_ids=
                 except:
                     continue
         patient_names = tmpName
+        count('warnings_blank_patient')
         warnings.warn('failed to parse PatientName %s, append a blank' % patient_name)
     if len(patient_ids) != n:
-        tmpId = 3 * ['blank']
+        tmpId = n * ['blank']
         for i in range(len(order)):
             if int(order[i]) != 0:
                 try:
@@ -352,6 +1392,7 @@ def get_patient_TB(patient_name, patient_id, n, patient_names=None, patient_ids=
                 except:
                     continue
         patient_ids = tmpId
+        count('warnings_blank_patient')
         warnings.warn('failed to parse PatientID %s, append a blank' % patient_id)
     source_patient = Dataset()
     # FIXME: remove '_1'?
@@ -369,7 +1410,7 @@ def get_patient(patient_name, patient_id, n, patient_names=None, patient_ids=Non
         # patient_ids, id_trailing = parse_patient(patient_id)
     # print(patient_names)
     if len(patient_names) != n:
-        tmpName = 3 * ['blank']
+        tmpName = n * ['blank']
         for i in range(len(order)):
             if int(order[i]) != 0:
                 try:
@@ -377,9 +1418,10 @@ def get_patient(patient_name, patient_id, n, patient_names=None, patient_ids=Non
                 except:
                     continue
         patient_names = tmpName
+        count('warnings_blank_patient')
         warnings.warn('failed to parse PatientName %s, append a blank' % patient_name)
     if len(patient_ids) != n:
-        tmpId = 3 * ['blank']
+        tmpId = n * ['blank']
         for i in range(len(order)):
             if int(order[i]) != 0:
                 try:
@@ -387,6 +1429,7 @@ def get_patient(patient_name, patient_id, n, patient_names=None, patient_ids=Non
                 except:
                     continue
         patient_ids = tmpId
+        count('warnings_blank_patient')
         warnings.warn('failed to parse PatientID %s, append a blank' % patient_id)
     source_patient = Dataset()
     # FIXME: remove '_1'?
@@ -396,38 +1439,805 @@ def get_patient(patient_name, patient_id, n, patient_names=None, patient_ids=Non
     return (patient_names, patient_ids), Sequence([source_patient]), (name_trailing, id_trailing)
 
 
+def number_of_frames(dataset):
+    return int(dataset.get('NumberOfFrames', 1) or 1)
+
+
+def is_multi_frame(dataset, pixel_array):
+    # frames first, then rows and columns (and samples)
+    return number_of_frames(dataset) > 1 and \
+        pixel_array.ndim == (3 if dataset.get('SamplesPerPixel', 1) == 1 else 4)
+
+
 def set_pixel_data(dataset, pixel_array):
-    dataset.PixelData = pixel_array.tostring()
-    dataset.Rows, dataset.Columns = pixel_array.shape
-
-def checkDirectory(directory, output_dir=None):
-    for root, subdirs, files in os.walk(directory):
-        if len(files):
-            if files.pop(0) != '.DS_Store':
-                newRoot = output_dir
-                for subdirs in root.split('/')[1:]:
-                    newRoot = os.path.join(newRoot, subdirs)
-                if not os.path.exists(newRoot):
-                    os.makedirs(newRoot)
-                yield root, newRoot
-def split_dicom_directory(directory, axis=0, n=3, nTB=None, offset=5, keep_origin=False,
-                          study_instance_uids=None, series_instance_uids=None,
-                          series_descriptions=None, output_dir=None,
-                          derivation_description=None, patient_names=None,
-                          patient_ids=None, output_paths=None,
-                          mangle_output_paths=False, order=None, orderT=None, orderB=None):
+    # copies only when the split is not already contiguous
+    pixel_array = numpy.ascontiguousarray(pixel_array)
+    dataset.PixelData = memoryview(pixel_array).cast('B')
+    if is_multi_frame(dataset, pixel_array):
+        dataset.Rows, dataset.Columns = pixel_array.shape[1:3]
+    else:
+        dataset.Rows, dataset.Columns = pixel_array.shape[:2]
+
+
+def load_pixel_frames(split_dataset):
+    # frames left for chunked writing are needed in memory after all
+    pixel_frames = getattr(split_dataset, 'pixel_frames', None)
+    if pixel_frames is not None:
+        set_pixel_data(split_dataset, pixel_frames)
+        del split_dataset.pixel_frames
+        del split_dataset.frames_per_chunk
+    return split_dataset
+
+
+def save_pixel_frames(split_dataset, filename):
+    # the header by save_as, then the pixel data element frame chunk by frame
+    # chunk, so at most frames_per_chunk frames are copied at once
+    pixel_frames = split_dataset.pixel_frames
+    frames_per_chunk = split_dataset.frames_per_chunk
+    trailing = Dataset()
+    for tag in [tag for tag in split_dataset.keys() if tag > PIXEL_DATA]:
+        trailing[tag] = split_dataset[tag]
+        del split_dataset[tag]
+    length = pixel_frames.nbytes
+    endian = '<' if split_dataset.is_little_endian else '>'
+    if split_dataset.is_implicit_VR:
+        element = struct.pack(endian + 'HHL', PIXEL_DATA.group, PIXEL_DATA.element,
+                              length + length % 2)
+    else:
+        vr = b'OB' if split_dataset.BitsAllocated <= 8 else b'OW'
+        element = struct.pack(endian + 'HH2sHL', PIXEL_DATA.group, PIXEL_DATA.element,
+                              vr, 0, length + length % 2)
+    with open(filename, 'wb') as fp:
+        split_dataset.save_as(fp)
+        fp.write(element)
+        for start in range(0, len(pixel_frames), frames_per_chunk):
+            chunk = numpy.ascontiguousarray(pixel_frames[start:start + frames_per_chunk])
+            fp.write(memoryview(chunk).cast('B'))
+        if length % 2:
+            fp.write(b'\0')
+        if len(trailing):
+            buffer = DicomBytesIO()
+            buffer.is_little_endian = split_dataset.is_little_endian
+            buffer.is_implicit_VR = split_dataset.is_implicit_VR
+            write_dataset(buffer, trailing)
+            fp.write(buffer.getvalue())
+
+
+def copy_header(dataset, exclude=()):
+    # copy element by element, deepcopy would follow the sequence parents
+    # back into the source dataset and copy its PixelData
+    header = Dataset()
+    for element in dataset.elements():
+        if element.tag in exclude:
+            continue
+        # raw elements are immutable and can be shared
+        if isinstance(element, DataElement):
+            if element.VR == 'SQ':
+                value = Sequence([copy_header(item) for item in element.value])
+            else:
+                value = copy.deepcopy(element.value)
+            element = DataElement(element.tag, element.VR, value,
+                                  is_undefined_length=element.is_undefined_length,
+                                  already_converted=True)
+        header[element.tag] = element
+    return header
+
+
+def pixel_data_offset(fp, dataset):
+    # stop_before_pixels leaves fp at the PixelData tag
+    tag = fp.read(4)
+    if len(tag) < 4:
+        return None
+    group, element = struct.unpack('<HH', tag)
+    if Tag(group, element) != PIXEL_DATA:
+        return None
+    if not dataset.is_implicit_VR:
+        # OB/OW: VR and 2 reserved bytes
+        fp.read(4)
+    length, = struct.unpack('<L', fp.read(4))
+    if length == 0xffffffff:
+        # encapsulated
+        return None
+    return fp.tell(), length
+
+
+def is_mappable(dataset):
+    return dataset.file_meta.get('TransferSyntaxUID') in MAPPED_TRANSFER_SYNTAXES and \
+        dataset.get('SamplesPerPixel', 1) == 1 and \
+        dataset.get('BitsAllocated') in (8, 16, 32, 64) and \
+        'Rows' in dataset and 'Columns' in dataset
+
+
+def map_pixel_array(path):
+    with open(path, 'rb') as fp:
+        with timed('dcmread'):
+            dataset = pydicom.dcmread(fp, stop_before_pixels=True)
+        if not is_mappable(dataset):
+            return None
+        located = pixel_data_offset(fp, dataset)
+    if located is None:
+        return None
+    pixel_array = memory_map(path, dataset, *located)
+    if pixel_array is None:
+        return None
+    return dataset, pixel_array
+
+
+def map_indexed_pixel_array(path, dataset):
+    # the header index (or the scan) knows where the pixels are, nothing is
+    # parsed; the index only has the offset, the rest of the file bounds it
+    offset = getattr(dataset, 'pixel_data_offset', None)
+    if offset is None or not is_mappable(dataset):
+        return None
+    if metrics is not None:
+        count('files_read')
+        count('bytes_read', os.path.getsize(path))
+    length = getattr(dataset, 'pixel_data_length', None)
+    if length is None:
+        length = os.path.getsize(path) - int(offset)
+    return memory_map(path, dataset, int(offset), length)
+
+
+def memory_map(path, dataset, offset, length):
+    dtype = pixel_dtype(dataset)
+    shape = (dataset.Rows, dataset.Columns)
+    if number_of_frames(dataset) > 1:
+        # frames are only paged in when they are cropped and written
+        shape = (number_of_frames(dataset),) + shape
+    if length < numpy.prod(shape) * dtype.itemsize:
+        return None
+    with timed('pixel_decode'):
+        return numpy.memmap(path, dtype, 'r', offset, shape)
+
+
+def read_pixel_array(path):
+    # uncompressed little endian pixels are cropped straight from a
+    # memory map, everything else is read and decoded by pydicom
+    if metrics is not None:
+        count('files_read')
+        count('bytes_read', os.path.getsize(path))
+    mapped = map_pixel_array(path)
+    if mapped is not None:
+        return mapped
+    with timed('dcmread'):
+        dataset = pydicom.dcmread(path)
+    try:
+        with timed('pixel_decode'):
+            pixel_array = dataset.pixel_array
+    except (TypeError, AttributeError):
+        pixel_array = None
+    return dataset, pixel_array
+
+
+def build_split_dataset(dataset, pixel_array=None, frame_memory=None):
+    exclude = () if pixel_array is None else (PIXEL_DATA,)
+    with timed('copy_header'):
+        split_dataset = FileDataset(getattr(dataset, 'filename', None),
+                                    copy_header(dataset, exclude),
+                                    preamble=getattr(dataset, 'preamble', None),
+                                    file_meta=copy.deepcopy(dataset.file_meta),
+                                    is_implicit_VR=dataset.is_implicit_VR,
+                                    is_little_endian=dataset.is_little_endian)
+    if pixel_array is not None:
+        with timed('split'):
+            if frame_memory is not None and is_multi_frame(dataset, pixel_array) \
+                    and pixel_array.nbytes > frame_memory:
+                # left as a view, save_split_dataset writes it in chunks
+                split_dataset.pixel_frames = pixel_array
+                split_dataset.frames_per_chunk = max(
+                    1, frame_memory // (pixel_array[0].nbytes or 1))
+                split_dataset.Rows, split_dataset.Columns = pixel_array.shape[1:3]
+            else:
+                set_pixel_data(split_dataset, pixel_array)
+        # the pixels are written decoded, whatever the source was
+        transfer_syntax = split_dataset.file_meta.get('TransferSyntaxUID')
+        if transfer_syntax is not None and UID(transfer_syntax).is_compressed:
+            split_dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            split_dataset.is_implicit_VR = False
+            split_dataset.is_little_endian = True
+    return split_dataset
+
+
+def read_stream_dataset(source):
+    # datasets are copied so the caller's header is left alone, anything
+    # else (a path or a file-like object) is read by dcmread
+    if isinstance(source, Dataset):
+        file_meta = getattr(source, 'file_meta', None)
+        if file_meta is None:
+            file_meta = FileMetaDataset()
+            file_meta.MediaStorageSOPClassUID = source.get('SOPClassUID')
+            file_meta.MediaStorageSOPInstanceUID = source.get('SOPInstanceUID')
+            file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        is_implicit_VR = getattr(source, 'is_implicit_VR', None)
+        is_little_endian = getattr(source, 'is_little_endian', None)
+        if is_implicit_VR is None or is_little_endian is None:
+            transfer_syntax = UID(file_meta.get('TransferSyntaxUID', ExplicitVRLittleEndian))
+            is_implicit_VR = transfer_syntax.is_implicit_VR
+            is_little_endian = transfer_syntax.is_little_endian
+        with timed('copy_header'):
+            dataset = FileDataset(None, copy_header(source),
+                                  preamble=getattr(source, 'preamble', None) or b'\0' * 128,
+                                  file_meta=copy.deepcopy(file_meta),
+                                  is_implicit_VR=is_implicit_VR,
+                                  is_little_endian=is_little_endian)
+    else:
+        count('files_read')
+        with timed('dcmread'):
+            dataset = pydicom.dcmread(source)
+    try:
+        with timed('pixel_decode'):
+            pixel_array = dataset.pixel_array
+    except (TypeError, AttributeError):
+        pixel_array = None
+    return dataset, pixel_array
+
+
+def compress_split_dataset(split_dataset, encoding):
+    load_pixel_frames(split_dataset)
+    transfer_syntax = ENCODINGS[encoding]
+    split_dataset.is_implicit_VR = False
+    split_dataset.is_little_endian = True
+    if transfer_syntax == RLELossless and 'PixelData' in split_dataset:
+        if split_dataset.get('SamplesPerPixel', 1) != 1:
+            warnings.warn('RLE Lossless is only written for one sample per'
+                          ' pixel, %s is left uncompressed'
+                          % split_dataset.SOPInstanceUID)
+            split_dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            return split_dataset
+        with timed('encode'):
+            pixel_array = numpy.frombuffer(split_dataset.PixelData,
+                                           pixel_dtype(split_dataset))
+            pixel_array = pixel_array.reshape(number_of_frames(split_dataset),
+                                              split_dataset.Rows,
+                                              split_dataset.Columns)
+            # one fragment per frame
+            split_dataset.PixelData = encapsulate([rle_encode_frame(frame)
+                                                   for frame in pixel_array])
+        split_dataset['PixelData'].VR = 'OB'
+        split_dataset['PixelData'].is_undefined_length = True
+    split_dataset.file_meta.TransferSyntaxUID = transfer_syntax
+    return split_dataset
+
+
+def encode_split_dataset(split_dataset, encoding=None):
+    load_pixel_frames(split_dataset)
+    if encoding is not None:
+        compress_split_dataset(split_dataset, encoding)
+    buffer = io.BytesIO()
+    with timed('save_as'):
+        split_dataset.save_as(buffer)
+    encoded = buffer.getvalue()
+    count('bytes_encoded', len(encoded))
+    return encoded
+
+
+def detach_parents(dataset):
+    # parsed sequences point back at their datasets through weakrefs, which
+    # can not be pickled; nothing written needs them
+    for element in dataset.elements():
+        if isinstance(element, DataElement) and element.VR == 'SQ':
+            element.value._parent = None
+            for item in element.value:
+                item.parent = None
+                detach_parents(item)
+
+
+def encoded_splits(splits, encoding=None, encoder=None, window=None):
+    # yields (i, split dataset) as is, or (i, file bytes) encoded inline or
+    # on the encoder pool, at most window splits in flight, in order
+    if encoding is None:
+        yield from splits
+        return
+    if encoder is None:
+        for i, split_dataset in splits:
+            yield i, encode_split_dataset(split_dataset, encoding)
+        return
+    if window is None:
+        window = 2 * (os.cpu_count() or 1)
+    # the pool's encode timings and byte counts are merged back as each
+    # split is collected, like the --workers results
+    profiled = metrics is not None
+    encode = functools.partial(run_profiled, encode_split_dataset) if profiled \
+        else encode_split_dataset
+
+    def result(future):
+        if not profiled:
+            return future.result()
+        data, snapshot = future.result()
+        metrics.merge(snapshot)
+        return data
+
+    pending = collections.deque()
+    try:
+        for i, split_dataset in splits:
+            load_pixel_frames(split_dataset)
+            # the split is a memoryview on the source, which can not be pickled
+            if isinstance(split_dataset.get('PixelData'), memoryview):
+                split_dataset.PixelData = split_dataset.PixelData.tobytes()
+            detach_parents(split_dataset)
+            pending.append((i, encoder.submit(encode, split_dataset, encoding)))
+            while len(pending) > window:
+                i, future = pending.popleft()
+                yield i, result(future)
+        while pending:
+            i, future = pending.popleft()
+            yield i, result(future)
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+def is_dicom_file(path):
+    try:
+        with open(path, 'rb') as fp:
+            return fp.read(132)[128:] == b'DICM'
+    except OSError:
+        return False
+
+
+def dicomdir_key(path):
+    # DICOMDIR file IDs are upper case, whatever the file system shows
+    return os.path.normpath(path).upper()
+
+
+def read_dicomdir(path):
+    # keys of the files referenced by image records, resolved from the
+    # DICOMDIR's own directory, and of any other record type so they are
+    # never opened
+    images, others = set(), set()
+    try:
+        dicomdir = pydicom.dcmread(path, stop_before_pixels=True)
+    except (pydicom.errors.InvalidDicomError, OSError):
+        warnings.warn('%s is not a valid DICOMDIR' % path)
+        return images, others
+    for record in dicomdir.get('DirectoryRecordSequence', []):
+        file_id = record.get('ReferencedFileID')
+        if not file_id:
+            continue
+        if isinstance(file_id, str):
+            file_id = [file_id]
+        key = dicomdir_key(os.path.join(os.path.dirname(path), *map(str, file_id)))
+        if record.get('DirectoryRecordType') == 'IMAGE':
+            images.add(key)
+        else:
+            others.add(key)
+    return images, others - images
+
+
+def scan_directory(directory):
+    # breadth first over os.scandir, each directory is listed exactly once
+    directories = collections.deque([directory])
+    while directories:
+        root = directories.popleft()
+        files = []
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry)
+        yield root, files
+
+
+def checkDirectory(directory, output_dir=None, create=True):
+    for root, files in scan_directory(directory):
+        if any(entry.name != '.DS_Store' for entry in files):
+            newRoot = output_dir
+            for subdirs in root.split('/')[1:]:
+                newRoot = os.path.join(newRoot, subdirs)
+            if create and not os.path.exists(newRoot):
+                os.makedirs(newRoot)
+            yield root, newRoot, files
+def split_counts(nTB):
+    nT, nB = map(int, nTB[0].split(','))
+    return nT, nB
+
+
+def make_splitter(pixel_array, axis=0, n=3, nTB=None, offset=5, grid=None,
+                  boxes=None):
+    if boxes is not None:
+        return DICOMSplitterBoxes(pixel_array, *boxes)
+    if grid is not None:
+        return DICOMSplitterGrid(pixel_array, *grid)
     if nTB is not None:
-        orderT = orderT.split(',')
-        orderB = orderB.split(',')
-        if int(kwargs.get('nTB')[0].split(',')[0]) != len(orderT):
+        nT, nB = split_counts(nTB)
+        return DICOMSplitterTB(pixel_array, axis, nT, nB, offset)
+    return DICOMSplitter(pixel_array, axis, n)
+
+
+def crop_splits(dataset, pixel_array, boxes):
+    # one view per (i, (start, stop)), the same crop of every frame of a
+    # multi-frame pixel array
+    frames = (slice(None),) if is_multi_frame(dataset, pixel_array) else ()
+    return [(i, start, pixel_array[frames + tuple(map(slice, start, stop))])
+            for i, (start, stop) in boxes]
+
+
+def make_splits(dataset, pixel_array, axis=0, n=3, nTB=None, offset=5, grid=None,
+                boxes=None):
+    if pixel_array is None or not is_multi_frame(dataset, pixel_array):
+        return make_splitter(pixel_array, axis, n, nTB, offset, grid, boxes)
+    dicom_splitter = make_splitter(None, axis, n, nTB, offset, grid, boxes)
+    boxes = crop_plan(dicom_splitter, pixel_array.shape[1:3])
+    return crop_splits(dataset, pixel_array,
+                       [(i, boxes[i]) for i, _, _ in dicom_splitter])
+
+
+def split_datasets(dataset, splits, patient, study_instance_uids,
+                   series_instance_uids, keep_origin=False,
+                   series_descriptions=None, derivation_description=None,
+                   affine_matrix=None, namespace=None, skip=(),
+                   frame_memory=None):
+    dataset.ImageType = ['DERIVED', 'PRIMARY', 'SPLIT']
+
+    dataset.DerivationDescription = derivation_description
+
+    dataset.DerivationImageSequence = derive_image_sequence(dataset.SOPClassUID, dataset.SOPInstanceUID)
+
+    parsed, dataset.SourcePatientGroupIdentificationSequence, trailing = patient
+
+    parsed_patient_names, parsed_patient_ids = parsed
+
+    for i, origin, pixel_array in splits:
+        if parsed_patient_names[i] == 'blank' or i in skip:
+            count('splits_skipped')
+        else:
+            split_dataset = build_split_dataset(dataset, pixel_array, frame_memory)
+
+            with timed('header_rewrite'):
+                # a plan moves the origin of header only splits
+                if origin is not None:
+                    if not keep_origin:
+                        if affine_matrix is None and has_geometry(dataset):
+                            affine_matrix = affine(dataset)
+                        if affine_matrix is not None:
+                            position = affine_matrix.dot(numpy.append(origin, [0, 1]))
+                            # maximum 16 characters
+                            split_dataset.ImagePositionPatient = [str(p)[:16] for p in position[:3]]
+                        update_frame_positions(split_dataset, origin)
+
+                if namespace is None:
+                    split_dataset.SOPInstanceUID = x667_uuid()
+                else:
+                    split_dataset.SOPInstanceUID = derived_uid(namespace, dataset.SOPInstanceUID, i)
+                split_dataset.file_meta.MediaStorageSOPInstanceUID = split_dataset.SOPInstanceUID
+
+                split_dataset.StudyInstanceUID = study_instance_uids[i]
+
+                split_dataset.SeriesInstanceUID = series_instance_uids[i]
+                split_dataset.StorageMediaFileSetUID = series_instance_uids[i] + '.0'
+
+                if series_descriptions:
+                    split_dataset.SeriesDescription = series_descriptions[i]
+                else:
+                    if split_dataset.Modality == 'PT':
+                        split_dataset.SeriesDescription = parsed_patient_ids[i] + '.pet split'
+                    elif split_dataset.Modality == 'CT':
+                        split_dataset.SeriesDescription = parsed_patient_ids[i] + '.ct split'
+                    else:
+                        split_dataset.SeriesDescription += ' split'
+
+                split_dataset.PatientName = parsed_patient_names[i]
+                split_dataset.PatientID = parsed_patient_ids[i]
+
+                split_dataset.SeriesNumber = (10 *  split_dataset.SeriesNumber) + i + 1
+
+            yield i, split_dataset
+
+
+def split_output_path(i, patient, output_paths=None, mangle_output_paths=False):
+    (parsed_patient_names, parsed_patient_ids), _, trailing = patient
+    name_trailing, id_trailing = trailing
+    if output_paths:
+        return os.path.join(output_paths, output_paths[i])
+    elif mangle_output_paths:
+        return parsed_patient_ids[i] + id_trailing
+    return None
+
+
+def write_split_dataset(split_dataset, filename):
+    with timed('save_as'):
+        if isinstance(split_dataset, bytes):
+            # already encoded on the encoder pool
+            with open(filename, 'wb') as fp:
+                fp.write(split_dataset)
+        elif getattr(split_dataset, 'pixel_frames', None) is not None:
+            save_pixel_frames(split_dataset, filename)
+        else:
+            split_dataset.save_as(filename)
+    if metrics is not None:
+        count('files_written')
+        count('bytes_written', os.path.getsize(filename))
+
+
+def save_split_dataset(split_dataset, i, path, output_root, patient,
+                       output_paths=None, mangle_output_paths=False,
+                       archive=None):
+    parsed_patient_names = patient[0][0]
+    output_path = split_output_path(i, patient, output_paths, mangle_output_paths)
+    if archive is not None:
+        # streamed into the subject's (or the run's) archive, no file
+        if output_path is None:
+            output_path = directory_name(output_root, parsed_patient_names[i])
+        if isinstance(split_dataset, bytes):
+            data = split_dataset
+        else:
+            data = encode_split_dataset(split_dataset)
+        with timed('archive'):
+            archive.add(output_path, os.path.basename(path), data)
+        if metrics is not None:
+            count('files_written')
+            count('bytes_written', len(data))
+        return
+    created_output_path = make_output_path(output_root, parsed_patient_names[i], output_path)
+
+    filename = os.path.join(created_output_path, os.path.basename(path))
+    write_split_dataset(split_dataset, filename)
+
+
+def series_key(dataset):
+    return (dataset.get('SeriesInstanceUID'), dataset.get('Rows'),
+            dataset.get('Columns'),
+            tuple(map(str, dataset.get('ImageOrientationPatient') or ())),
+            tuple(map(str, dataset.get('PixelSpacing') or ())))
+
+
+def make_series(dataset, n, namespace, nTB=None, patient_names=None,
+                patient_ids=None, order=None, study_instance_uids=None,
+                series_instance_uids=None, keep_origin=False, boxes=None):
+    if nTB is not None:
+        get_patient_fn = get_patient_TB
+    else:
+        get_patient_fn = get_patient
+    patient = get_patient_fn(dataset.PatientName, dataset.PatientID, n,
+                             copy.copy(patient_names), copy.copy(patient_ids),
+                             order)
+    # derived from the source UIDs, an evicted series gets the same UIDs back
+    if not study_instance_uids:
+        study_instance_uids = [derived_uid(namespace, dataset.get('StudyInstanceUID'), i)
+                               for i in range(n)]
+    if not series_instance_uids:
+        series_instance_uids = [derived_uid(namespace, dataset.get('SeriesInstanceUID'), i)
+                                for i in range(n)]
+    if keep_origin or not has_geometry(dataset):
+        affine_matrix = None
+    else:
+        affine_matrix = affine(dataset)
+    return Series(patient, study_instance_uids, series_instance_uids,
+                  affine_matrix, namespace, boxes)
+
+
+def slice_affine(series, dataset):
+    if series.affine_matrix is None:
+        return None
+    affine_matrix = series.affine_matrix.copy()
+    affine_matrix[:3, 3] = numpy.array(dataset.ImagePositionPatient, numpy.float64)
+    return affine_matrix
+
+
+def split_dicom_file(path, output_root, series, skip=(), axis=0, n=3,
+                     nTB=None, offset=5, grid=None, keep_origin=False,
+                     series_descriptions=None, derivation_description=None,
+                     output_paths=None, mangle_output_paths=False,
+                     archive=None, encoding=None, encoder=None,
+                     frame_memory=None, header=None):
+    # header is the scan's own parse of path, when the split runs in the
+    # same process; an index entry only holds some of the header
+    pixel_array = None
+    if header is not None and getattr(header, 'pixel_data_length', None) is not None:
+        pixel_array = map_indexed_pixel_array(path, header)
+    if pixel_array is None:
+        dataset, pixel_array = read_pixel_array(path)
+    else:
+        dataset = header
+    dicom_splitter = make_splits(dataset, pixel_array, axis, n, nTB, offset,
+                                 grid, series.boxes)
+    source_instance_uid = dataset.SOPInstanceUID
+    done = []
+    splits = split_datasets(dataset, dicom_splitter, series.patient,
+                            series.study_instance_uids,
+                            series.series_instance_uids,
+                            keep_origin, series_descriptions,
+                            derivation_description,
+                            slice_affine(series, dataset),
+                            series.namespace, skip, frame_memory)
+    for i, split_dataset in encoded_splits(splits, encoding, encoder):
+        save_split_dataset(split_dataset, i, path, output_root, series.patient,
+                           output_paths, mangle_output_paths, archive)
+        done.append((source_instance_uid, i))
+    return done
+
+
+def slice_position(dataset):
+    position = dataset.get('ImagePositionPatient')
+    orientation = dataset.get('ImageOrientationPatient')
+    if position is None or orientation is None:
+        return 0.0
+    normal = numpy.cross(numpy.array(orientation[:3], numpy.float64),
+                         numpy.array(orientation[3:], numpy.float64))
+    return float(normal.dot(numpy.array(position, numpy.float64)))
+
+
+def sort_series(datasets):
+    # sort slices along the slice normal, then by InstanceNumber
+    return sorted(datasets, key=lambda item: (slice_position(item[1]),
+                                              int(item[1].get('InstanceNumber', 0) or 0)))
+
+
+def split_dicom_series(paths, output_root, series, skips=None, axis=0, n=3,
+                       nTB=None, offset=5, grid=None, keep_origin=False,
+                       series_descriptions=None, derivation_description=None,
+                       output_paths=None, mangle_output_paths=False,
+                       archive=None, encoding=None, encoder=None,
+                       frame_memory=None):
+    if skips is None:
+        skips = [()] * len(paths)
+    split = functools.partial(split_dicom_file, output_root=output_root,
+                              series=series, axis=axis, n=n, nTB=nTB, offset=offset,
+                              grid=grid,
+                              keep_origin=keep_origin,
+                              series_descriptions=series_descriptions,
+                              derivation_description=derivation_description,
+                              output_paths=output_paths,
+                              mangle_output_paths=mangle_output_paths,
+                              archive=archive, encoding=encoding,
+                              encoder=encoder, frame_memory=frame_memory)
+    # each slice is copied into the volume as it is read, so only one
+    # memory map (and file descriptor) is held at a time
+    datasets = []
+    dtypes = []
+    volume = None
+    for z, path in enumerate(paths):
+        dataset, pixel_array = read_pixel_array(path)
+        if pixel_array is None or pixel_array.ndim != 2 or \
+                (volume is not None and pixel_array.shape != volume.shape[1:]):
+            warnings.warn('series in %s can not be stacked, splitting file by file'
+                          % output_root)
+            return [pair for path, skip in zip(paths, skips)
+                    for pair in split(path, skip=skip)]
+        if volume is None:
+            volume = numpy.empty((len(paths),) + pixel_array.shape, pixel_array.dtype)
+        elif pixel_array.dtype != volume.dtype:
+            volume = volume.astype(numpy.result_type(volume, pixel_array))
+        volume[z] = pixel_array
+        datasets.append(dataset)
+        dtypes.append(pixel_array.dtype)
+        del pixel_array
+
+    dicom_splitter = make_splitter(None, axis, n, nTB, offset, grid, series.boxes)
+    boxes = crop_plan(dicom_splitter, volume.shape[1:], len(volume))
+    # one 3D view per subject, masked cells are left out
+    crops = [(i, boxes[i][0], volume[(slice(None),) + tuple(map(slice, *boxes[i]))])
+             for i, _, _ in dicom_splitter]
+
+    def splits():
+        # keyed by slice, so the encoder window spans the whole series
+        # each slice goes back to its own dtype, which its BitsAllocated
+        # and PixelRepresentation still describe after a promoted stack
+        for z, (dataset, skip) in enumerate(zip(datasets, skips)):
+            splits = ((i, start, crop[z].astype(dtypes[z], copy=False))
+                      for i, start, crop in crops)
+            for i, split_dataset in split_datasets(dataset, splits, series.patient,
+                                                   series.study_instance_uids,
+                                                   series.series_instance_uids,
+                                                   keep_origin,
+                                                   series_descriptions,
+                                                   derivation_description,
+                                                   slice_affine(series, dataset),
+                                                   series.namespace, skip):
+                yield (z, i), split_dataset
+
+    done = []
+    for (z, i), split_dataset in encoded_splits(splits(), encoding, encoder):
+        save_split_dataset(split_dataset, i, paths[z], output_root,
+                           series.patient, output_paths,
+                           mangle_output_paths, archive)
+        done.append((datasets[z].SOPInstanceUID, i))
+    return done
+
+
+def split_dicom_pipeline(paths, output_roots, series, skips, readers=2,
+                         writers=2, memory_budget=512 * 2 ** 20, axis=0, n=3,
+                         nTB=None, offset=5, grid=None, keep_origin=False,
+                         series_descriptions=None, derivation_description=None,
+                         output_paths=None, mangle_output_paths=False,
+                         archive=None, encoding=None, encoder=None,
+                         frame_memory=None):
+    # reader threads prefetch while the budget allows, this thread splits and
+    # rewrites headers, writer threads save; yields the finished pairs
+    budget = MemoryBudget(memory_budget)
+
+    def read(ticket, path):
+        try:
+            nbytes = os.path.getsize(path)
+        except OSError:
+            budget.acquire(0, ticket=ticket)
+            raise
+        budget.acquire(nbytes, ticket=ticket)
+        try:
+            return read_pixel_array(path) + (nbytes,)
+        except BaseException:
+            budget.release(nbytes)
+            raise
+
+    def write(split_dataset, nbytes, i, path, output_root, series, source_instance_uid):
+        try:
+            save_split_dataset(split_dataset, i, path, output_root,
+                               series.patient, output_paths,
+                               mangle_output_paths, archive)
+        finally:
+            budget.release(nbytes)
+        return [(source_instance_uid, i)]
+
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(readers) as reading, \
+            concurrent.futures.ThreadPoolExecutor(writers) as writing, \
+            contextlib.closing(budget):
+        read_results = reading.map(read, range(len(paths)), paths)
+        for (dataset, pixel_array, nbytes), path, output_root, series_, skip in \
+                zip(read_results, paths, output_roots, series, skips):
+            dicom_splitter = make_splits(dataset, pixel_array, axis, n, nTB,
+                                         offset, grid, series_.boxes)
+            source_instance_uid = dataset.SOPInstanceUID
+            splits = split_datasets(dataset, dicom_splitter, series_.patient,
+                                    series_.study_instance_uids,
+                                    series_.series_instance_uids,
+                                    keep_origin, series_descriptions,
+                                    derivation_description,
+                                    slice_affine(series_, dataset),
+                                    series_.namespace, skip, frame_memory)
+            for i, split_dataset in encoded_splits(splits, encoding, encoder):
+                if isinstance(split_dataset, bytes):
+                    split_nbytes = len(split_dataset)
+                else:
+                    split_nbytes = len(split_dataset.get('PixelData') or b'')
+                # never blocks here, the writers are what frees the budget
+                budget.acquire(split_nbytes, block=False)
+                # bounded hand-off to the writers
+                while len(pending) >= 2 * writers:
+                    yield pending.popleft().result()
+                pending.append(writing.submit(write, split_dataset,
+                                              split_nbytes, i, path,
+                                              output_root, series_,
+                                              source_instance_uid))
+            del dataset, pixel_array, dicom_splitter, splits
+            budget.release(nbytes)
+            while pending and pending[0].done():
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def split_layout(n=3, nTB=None, grid=None, grid_offsets=None, order=None,
+                 orderT=None, orderB=None, study_instance_uids=None,
+                 series_instance_uids=None, series_descriptions=None):
+    if grid is not None:
+        columns = [int(c) for c in grid.split(',')]
+        n = sum(columns)
+        order = order.split(',') if order is not None else n * ['1']
+        if n != len(order):
+            raise Exception('[ERROR] # of cells in the grid has to equal to length of order')
+        offsets = None
+        if grid_offsets is not None:
+            offsets = [int(o) for o in grid_offsets.split(',')]
+            if len(offsets) != len(columns):
+                raise Exception('[ERROR] # of rows in the grid has to equal to length of grid offsets')
+        # empty cells are never cropped
+        grid = (columns, offsets, [int(o) == 0 for o in order])
+    elif nTB is not None:
+        nT, nB = split_counts(nTB)
+        orderT = orderT.split(',') if orderT is not None else nT * ['1']
+        orderB = orderB.split(',') if orderB is not None else nB * ['1']
+        if nT != len(orderT):
             raise Exception('[ERROR] # of split has to equal to length of order on Top')
-        if int(kwargs.get('nTB')[0].split(',')[1]) != len(orderB):
+        if nB != len(orderB):
             raise Exception('[ERROR] # of split has to equal to length of order on Bottom')
         # print (orderT)
         # print (orderB)
         order = orderT + orderB
+        n = nT + nB
     else:
-        order = order.split(',')
+        order = order.split(',') if order is not None else n * ['1']
         if n != len(order):
             raise Exception('[ERROR] # of split has to equal to length of order')
         if series_instance_uids:
@@ -438,90 +2248,901 @@ def split_dicom_directory(directory, axis=0, n=3, nTB=None, offset=5, keep_origi
             raise ValueError
         if study_instance_uids and len(study_instance_uids) != n:
             raise ValueError
-    for directoryChecked, newRoot in checkDirectory(directory, output_dir):
+    return n, order, grid
 
-        for path, dataset in DICOMDirectory(directoryChecked):
-            try:
-                pixel_array = dataset.pixel_array
-            except (TypeError, AttributeError):
-                pixel_array = None
-            if nTB is not None:
-                nT = int(kwargs.get('nTB')[0].split(',')[0])
-                nB = int(kwargs.get('nTB')[0].split(',')[1])
-                dicom_splitter = DICOMSplitterTB(pixel_array, axis, nT, nB, offset)
-                n = nT + nB
+
+def split_dicom_directory(directory, axis=0, n=3, nTB=None, offset=5, keep_origin=False,
+                          study_instance_uids=None, series_instance_uids=None,
+                          series_descriptions=None, output_dir=None,
+                          derivation_description=None, patient_names=None,
+                          patient_ids=None, output_paths=None,
+                          mangle_output_paths=False, order=None, orderT=None, orderB=None,
+                          workers=None, volume=False, cache_size=128,
+                          index=None, uid_namespace=None, manifest=None,
+                          pipeline=False, readers=2, writers=2,
+                          memory_budget=512 * 2 ** 20, grid=None,
+                          grid_offsets=None, archive=None, archive_per='subject',
+                          encoding=None, encoders=None, selected_paths=None,
+                          series_cache=None, executor=None,
+                          frame_memory=64 * 2 ** 20, plan_rows=None,
+                          auto=False, auto_threshold=0.1, reference=None,
+                          trim=False, trim_threshold=0.1, trim_margin=10):
+    n, order, grid = split_layout(n, nTB, grid, grid_offsets, order, orderT,
+                                  orderB, study_instance_uids,
+                                  series_instance_uids, series_descriptions)
+
+    if pipeline and (volume or (workers is not None and workers > 1)):
+        raise Exception('[ERROR] pipeline splits file by file in one process'
+                        ', it can not be combined with volume or workers')
+    if archive is not None and (executor is not None or
+                                (workers is not None and workers > 1)):
+        raise Exception('[ERROR] archives are written by one process'
+                        ', it can not be combined with workers')
+
+    # per-series state is decided here, once, so that every worker writes
+    # the same UIDs and patients as the serial path would; a long running
+    # caller passes its own cache so later slices join the same series
+    if series_cache is None:
+        series_cache = SeriesCache(cache_size)
+    namespace = make_uid_namespace(uid_namespace)
+    if manifest is not None:
+        manifest = Manifest(manifest)
+        if uid_namespace is None and len(manifest):
+            warnings.warn('resuming from %s without a UID namespace, the '
+                          'remaining splits get new UIDs' % manifest.path)
+    jobs = {}
+    in_process = not pipeline and executor is None and (workers is None or workers <= 1)
+    header_index = None if index is None else HeaderIndex(index)
+    def headers():
+        # the tree is walked breadth first, a DICOMDIR is read before the
+        # subdirectories it lists
+        dicomdir = (set(), set())
+        # a --plan dry run leaves the output tree alone
+        for directoryChecked, newRoot, files in checkDirectory(directory, output_dir,
+                                                               plan_rows is None):
+            if selected_paths is not None:
+                # only these files, e.g. the new slices of a watched directory
+                files = [entry for entry in files if entry.path in selected_paths]
+                if not files:
+                    continue
+            for path, dataset in DICOMDirectory(directoryChecked, stop_before_pixels=True,
+                                                entries=files, index=header_index,
+                                                dicomdir=dicomdir):
+                yield newRoot, path, dataset
+
+    layouts = {}
+    if auto or trim or reference is not None:
+        # every series is laid out before its first split
+        header_list = list(headers())
+        dicom_splitter = make_splitter(None, axis, n, nTB, offset, grid)
+        mips = {}
+        if auto or trim:
+            # with a reference, only its series need a MIP, the others
+            # get its boxes
+            mips = series_mips([header for header in header_list
+                                if reference is None or
+                                is_reference(header[2], reference)])
+        if auto:
+            layouts = auto_layouts(mips, dicom_splitter, auto_threshold)
+        if trim:
+            layouts = trimmed_layouts(mips, dicom_splitter, order, layouts,
+                                      trim_threshold, trim_margin)
+        del mips
+        if reference is not None:
+            layouts = shared_layouts(header_list, dicom_splitter, order,
+                                     layouts, reference)
+    else:
+        header_list = headers()
+    for newRoot, path, dataset in header_list:
+        key = series_key(dataset)
+        series_order, boxes = layouts.get(key, (order, None))
+        series = series_cache.get(key, functools.partial(
+            make_series, dataset, n, namespace, nTB, patient_names,
+            patient_ids, series_order, study_instance_uids,
+            series_instance_uids, keep_origin, boxes))
+        skip = ()
+        if manifest is not None:
+            skip = manifest.skip(dataset.SOPInstanceUID, n)
+            parsed_patient_names = series.patient[0][0]
+            # done once every split it produces is, masked cells and
+            # blank patients never are
+            produced = make_splitter(None, axis, n, nTB, offset, grid, series.boxes)
+            if all(i in skip for i, _, _ in produced
+                   if parsed_patient_names[i] != 'blank'):
+                count('files_skipped')
+                continue
+        if volume:
+            job = (newRoot, key)
+        else:
+            job = (newRoot, path)
+        # headers are only kept for sorting the volume, planning and
+        # splitting in this process without parsing them again
+        keep = volume or plan_rows is not None or in_process
+        jobs.setdefault(job, (series, []))[1].append(
+            (path, dataset if keep else None, skip))
+    if header_index is not None:
+        header_index.close()
+
+    if plan_rows is not None:
+        # --plan: the rows are collected, nothing is read or written
+        for (newRoot, _), (series, files) in jobs.items():
+            for path, dataset, skip in files:
+                plan_rows.extend(plan_split_file(
+                    path, dataset, newRoot, series, skip, axis, n, nTB, offset,
+                    grid, keep_origin, series_descriptions,
+                    derivation_description, output_paths, mangle_output_paths))
+    elif jobs:
+        options = dict(axis=axis, n=n, nTB=nTB, offset=offset, grid=grid,
+                       keep_origin=keep_origin,
+                       series_descriptions=series_descriptions,
+                       derivation_description=derivation_description,
+                       output_paths=output_paths,
+                       mangle_output_paths=mangle_output_paths,
+                       encoding=encoding, frame_memory=frame_memory)
+        encoder = None
+        if encoding is not None and executor is None and \
+                (workers is None or workers <= 1):
+            # the workers already encode in parallel, one split at a time
+            encoder = concurrent.futures.ProcessPoolExecutor(encoders)
+            options['encoder'] = encoder
+        if archive is not None:
+            if archive_per == 'run':
+                name = os.path.basename(os.path.normpath(directory)) + '.' + archive
+                archive = SplitArchive(archive, os.path.join(output_dir, name),
+                                       output_dir)
+            else:
+                archive = SplitArchive(archive)
+            options['archive'] = archive
+        if volume:
+            split = functools.partial(split_dicom_series, **options)
+            slices = [sort_series(files) for _, files in jobs.values()]
+            paths = [[path for path, _, _ in files] for files in slices]
+            skips = [[skip for _, _, skip in files] for files in slices]
+        else:
+            split = functools.partial(split_dicom_file, **options)
+            paths = [files[0][0] for _, files in jobs.values()]
+            skips = [files[0][2] for _, files in jobs.values()]
+        output_roots = [job[0] for job in jobs]
+        series = [series for series, _ in jobs.values()]
+        shared_executor = executor
+        executor = None
+        if pipeline:
+            results = split_dicom_pipeline(paths, output_roots, series, skips,
+                                           readers, writers, memory_budget,
+                                           **options)
+        elif in_process and not volume:
+            headers = [files[0][1] for _, files in jobs.values()]
+            results = (split(path, output_root, job_series, skip, header=header)
+                       for path, output_root, job_series, skip, header
+                       in zip(paths, output_roots, series, skips, headers))
+        elif in_process:
+            results = map(split, paths, output_roots, series, skips)
+        else:
+            profiled = metrics is not None
+            if profiled:
+                split = functools.partial(run_profiled, split)
+            if shared_executor is None:
+                chunksize = max(1, len(jobs) // (4 * workers))
+                executor = concurrent.futures.ProcessPoolExecutor(workers)
+                results = executor.map(split, paths, output_roots, series,
+                                       skips, chunksize=chunksize)
+            else:
+                results = shared_executor.map(split, paths, output_roots,
+                                              series, skips)
+            if profiled:
+                results = merge_profiled(results)
+        try:
+            for done in results:
+                if manifest is not None:
+                    # never record splits still sitting in an archive buffer
+                    if archive is not None:
+                        archive.flush()
+                    manifest.update(done)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if encoder is not None:
+                encoder.shutdown()
+            if archive is not None:
+                archive.close()
+    if manifest is not None:
+        manifest.close()
+
+
+def plan_value(value):
+    # DICOM style multi-values in CSV cells
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        return '\\'.join(map(str, value))
+    return value
+
+
+def write_plan(path, rows):
+    with open(path, 'w', newline='') as fp:
+        if path.lower().endswith('.csv'):
+            writer = csv.DictWriter(fp, PLAN_FIELDS)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({key: plan_value(value) for key, value in row.items()})
+        else:
+            json.dump(rows, fp, indent=2)
+
+
+def read_plan(path):
+    with open(path, newline='') as fp:
+        if not path.lower().endswith('.csv'):
+            return json.load(fp)
+        rows = []
+        for row in csv.DictReader(fp):
+            row['split'] = int(row['split'])
+            row['box'] = [int(b) for b in row['box'].split('\\')] if row['box'] else None
+            row['image_position_patient'] = \
+                row['image_position_patient'].split('\\') if row['image_position_patient'] else None
+            row['keep_origin'] = row['keep_origin'] == 'True'
+            row['series_number'] = int(row['series_number'])
+            row['derivation_description'] = row['derivation_description'] or None
+            rows.append(row)
+        return rows
+
+
+def full_header(path, dataset):
+    # an index entry only holds INDEXED_KEYWORDS, the split header needs
+    # everything else too
+    if not getattr(dataset, 'from_index', False):
+        return dataset
+    with timed('dcmread'):
+        return pydicom.dcmread(path, stop_before_pixels=True)
+
+
+def plan_split_file(path, dataset, output_root, series, skip=(), axis=0, n=3,
+                    nTB=None, offset=5, grid=None, keep_origin=False,
+                    series_descriptions=None, derivation_description=None,
+                    output_paths=None, mangle_output_paths=False):
+    # the plan rows of one file from its header, no pixel is read
+    dataset = full_header(path, dataset)
+    dicom_splitter = make_splitter(None, axis, n, nTB, offset, grid, series.boxes)
+    if 'Rows' in dataset and 'Columns' in dataset:
+        boxes = crop_plan(dicom_splitter, (dataset.Rows, dataset.Columns))
+    else:
+        boxes = None
+    splits = [(i, None if boxes is None else boxes[i][0], None)
+              for i, _, _ in dicom_splitter]
+    source_instance_uid = dataset.SOPInstanceUID
+    rows = []
+    for i, split_dataset in split_datasets(dataset, splits, series.patient,
+                                           series.study_instance_uids,
+                                           series.series_instance_uids,
+                                           keep_origin, series_descriptions,
+                                           derivation_description,
+                                           slice_affine(series, dataset),
+                                           series.namespace, skip):
+        output_path = split_output_path(i, series.patient, output_paths,
+                                        mangle_output_paths)
+        if output_path is None:
+            output_path = directory_name(output_root, series.patient[0][0][i])
+        box = None
+        if boxes is not None:
+            (row_start, column_start), (row_stop, column_stop) = boxes[i]
+            box = [int(row_start), int(row_stop), int(column_start), int(column_stop)]
+        position = split_dataset.get('ImagePositionPatient')
+        rows.append(collections.OrderedDict([
+            ('source', path),
+            ('source_instance_uid', source_instance_uid),
+            ('split', i),
+            ('destination', os.path.join(output_path, os.path.basename(path))),
+            ('box', box),
+            ('image_position_patient', None if position is None else list(map(str, position))),
+            ('keep_origin', keep_origin),
+            ('patient_name', str(split_dataset.PatientName)),
+            ('patient_id', str(split_dataset.PatientID)),
+            ('study_instance_uid', split_dataset.StudyInstanceUID),
+            ('series_instance_uid', split_dataset.SeriesInstanceUID),
+            ('sop_instance_uid', split_dataset.SOPInstanceUID),
+            ('series_description', split_dataset.SeriesDescription),
+            ('series_number', int(split_dataset.SeriesNumber)),
+            ('derivation_description', split_dataset.get('DerivationDescription')),
+        ]))
+    return rows
+
+
+def split_planned_file(path, rows, frame_memory=None, encoding=None, encoder=None):
+    # exactly the planned splits of one file: boxes, patients, UIDs and
+    # destinations come from the plan rows
+    dataset, pixel_array = read_pixel_array(path)
+    planned = {row['split']: row for row in rows}
+    n = max(planned) + 1
+    patient_names, patient_ids = n * ['blank'], n * ['blank']
+    study_instance_uids, series_instance_uids = n * [None], n * [None]
+    series_descriptions = n * [None]
+    for i, row in planned.items():
+        patient_names[i], patient_ids[i] = row['patient_name'], row['patient_id']
+        study_instance_uids[i] = row['study_instance_uid']
+        series_instance_uids[i] = row['series_instance_uid']
+        series_descriptions[i] = row['series_description']
+    source_patient = Dataset()
+    source_patient.PatientName = dataset.PatientName
+    source_patient.PatientID = dataset.PatientID
+    patient = (patient_names, patient_ids), Sequence([source_patient]), ('', '')
+    if pixel_array is None or any(row['box'] is None for row in rows):
+        splits = [(i, None, None) for i in planned]
+    else:
+        splits = crop_splits(dataset, pixel_array, [
+            (i, (numpy.array(row['box'][0::2]), numpy.array(row['box'][1::2])))
+            for i, row in planned.items()])
+
+    def planned_splits():
+        for i, split_dataset in split_datasets(dataset, splits, patient,
+                                               study_instance_uids,
+                                               series_instance_uids,
+                                               rows[0]['keep_origin'],
+                                               series_descriptions,
+                                               rows[0]['derivation_description'],
+                                               frame_memory=frame_memory):
+            row = planned[i]
+            split_dataset.SOPInstanceUID = row['sop_instance_uid']
+            split_dataset.file_meta.MediaStorageSOPInstanceUID = row['sop_instance_uid']
+            split_dataset.SeriesNumber = row['series_number']
+            if row['image_position_patient'] is not None:
+                split_dataset.ImagePositionPatient = row['image_position_patient']
+            yield i, split_dataset
+
+    done = []
+    for i, split_dataset in encoded_splits(planned_splits(), encoding, encoder):
+        filename = planned[i]['destination']
+        os.makedirs(os.path.dirname(filename) or os.curdir, exist_ok=True)
+        write_split_dataset(split_dataset, filename)
+        done.append((planned[i]['source_instance_uid'], i))
+    return done
+
+
+def split_dicom_plan(plan, workers=None, encoding=None, encoders=None,
+                     frame_memory=64 * 2 ** 20, manifest=None):
+    # runs a --plan file, planning is not repeated
+    rows = read_plan(plan)
+    if manifest is not None:
+        manifest = Manifest(manifest)
+        rows = [row for row in rows
+                if (row['source_instance_uid'], row['split']) not in manifest]
+    sources = collections.OrderedDict()
+    for row in rows:
+        sources.setdefault(row['source'], []).append(row)
+    split = functools.partial(split_planned_file, frame_memory=frame_memory,
+                              encoding=encoding)
+    executor = encoder = None
+    try:
+        if workers is None or workers <= 1:
+            if encoding is not None:
+                encoder = concurrent.futures.ProcessPoolExecutor(encoders)
+                split = functools.partial(split, encoder=encoder)
+            results = map(split, sources, sources.values())
+        else:
+            profiled = metrics is not None
+            if profiled:
+                split = functools.partial(run_profiled, split)
+            chunksize = max(1, len(sources) // (4 * workers))
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+            results = executor.map(split, list(sources), list(sources.values()),
+                                   chunksize=chunksize)
+            if profiled:
+                results = merge_profiled(results)
+        for done in results:
+            if manifest is not None:
+                manifest.update(done)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if encoder is not None:
+            encoder.shutdown()
+        if manifest is not None:
+            manifest.close()
+
+
+def split_dicom_datasets(datasets, axis=0, n=3, nTB=None, offset=5,
+                         keep_origin=False, study_instance_uids=None,
+                         series_instance_uids=None, series_descriptions=None,
+                         derivation_description=None, patient_names=None,
+                         patient_ids=None, order=None, orderT=None, orderB=None,
+                         cache_size=128, uid_namespace=None, grid=None,
+                         grid_offsets=None, encode=False, encoding=None,
+                         series_cache=None):
+    # lazily yields (split index, patient name, split dataset) for every
+    # dataset, path or file-like object, nothing is written to disk; with
+    # encode the split datasets are yielded as DICOM file bytes, encoding
+    # compresses them (rle or deflate); a caller splitting over several
+    # calls passes its own series cache and namespace
+    n, order, grid = split_layout(n, nTB, grid, grid_offsets, order, orderT,
+                                  orderB, study_instance_uids,
+                                  series_instance_uids, series_descriptions)
+    if series_cache is None:
+        series_cache = SeriesCache(cache_size)
+    namespace = make_uid_namespace(uid_namespace)
+    for source in datasets:
+        try:
+            dataset, pixel_array = read_stream_dataset(source)
+        except pydicom.errors.InvalidDicomError:
+            dataset = None
+        if dataset is None or not hasattr(dataset, 'SOPInstanceUID'):
+            warnings.warn('%s is not a valid DICOM file'
+                          % getattr(source, 'name', type(source).__name__))
+            count('files_skipped')
+            continue
+        series = series_cache.get(series_key(dataset), functools.partial(
+            make_series, dataset, n, namespace, nTB, patient_names,
+            patient_ids, order, study_instance_uids, series_instance_uids,
+            keep_origin))
+        dicom_splitter = make_splits(dataset, pixel_array, axis, n, nTB, offset, grid)
+        parsed_patient_names = series.patient[0][0]
+        for i, split_dataset in split_datasets(dataset, dicom_splitter,
+                                               series.patient,
+                                               series.study_instance_uids,
+                                               series.series_instance_uids,
+                                               keep_origin, series_descriptions,
+                                               derivation_description,
+                                               slice_affine(series, dataset),
+                                               series.namespace):
+            if encode:
+                yield i, parsed_patient_names[i], encode_split_dataset(split_dataset,
+                                                                       encoding)
             else:
-                dicom_splitter = DICOMSplitter(pixel_array, axis, n)
-            dataset.ImageType = ['DERIVED', 'PRIMARY', 'SPLIT']
+                if encoding is not None:
+                    compress_split_dataset(split_dataset, encoding)
+                yield i, parsed_patient_names[i], split_dataset
 
-            dataset.DerivationDescription = derivation_description
 
-            dataset.DerivationImageSequence = derive_image_sequence(dataset.SOPClassUID, dataset.SOPInstanceUID)
-            if nTB is not None:
-                parsed, dataset.SourcePatientGroupIdentificationSequence, trailing = get_patient_TB(dataset.PatientName,
-                                                                                                 dataset.PatientID, n,
-                                                                                                 patient_names,
-                                                                                                 patient_ids, order)
-            else:
-                parsed, dataset.SourcePatientGroupIdentificationSequence, trailing = get_patient(dataset.PatientName, dataset.PatientID, n, patient_names, patient_ids, order)
+class StoreForwarder:
+    def __init__(self, address, port, ae_title='ANY-SCP',
+                 calling_ae_title='PYDICOM_SPLIT', associations=1,
+                 batch_size=16, batch_timeout=1.0):
+        # C-STOREs the splits in batches, each sender thread keeps its own
+        # association open between batches
+        try:
+            from pynetdicom import AE, build_context
+        except ImportError:
+            raise Exception('[ERROR] forwarding over DICOM needs pynetdicom')
+        self._build_context = build_context
+        self._address = address
+        self._port = port
+        self._ae_title = ae_title
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._ae = AE(ae_title=calling_ae_title)
+        # bounded, a slow destination holds back the splitting
+        self._queue = queue.Queue(2 * associations * batch_size)
+        # the first error a sender hit, re-raised by close()
+        self._error = None
+        self._senders = [threading.Thread(target=self._send, daemon=True)
+                         for _ in range(associations)]
+        for sender in self._senders:
+            sender.start()
 
+    @property
+    def address(self):
+        return self._address
 
-            parsed_patient_names, parsed_patient_ids = parsed
+    @property
+    def port(self):
+        return self._port
 
-            name_trailing, id_trailing = trailing
+    @property
+    def ae_title(self):
+        return self._ae_title
+
+    def put(self, dataset):
+        self._queue.put(dataset)
+
+    def _batch(self):
+        batch = []
+        deadline = None
+        while len(batch) < self._batch_size:
+            if deadline is None:
+                item = self._queue.get()
+                deadline = time.monotonic() + self._batch_timeout
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _contexts(self, batch):
+        # one transfer syntax per context, the peer accepts at most one
+        contexts = set()
+        for dataset in batch:
+            transfer_syntax = dataset.file_meta.TransferSyntaxUID
+            contexts.add((dataset.SOPClassUID, transfer_syntax))
+            if not UID(transfer_syntax).is_compressed:
+                contexts.add((dataset.SOPClassUID, ExplicitVRLittleEndian))
+                contexts.add((dataset.SOPClassUID, ImplicitVRLittleEndian))
+        return contexts
+
+    def _send(self):
+        association = None
+        negotiated = set()
+        closed = False
+        try:
+            while not closed:
+                batch, closed = self._batch()
+                if not batch:
+                    continue
+                sent = 0
+                try:
+                    contexts = self._contexts(batch)
+                    if association is not None and association.is_established \
+                            and not contexts <= negotiated:
+                        # a new SOP class or transfer syntax, negotiate again
+                        association.release()
+                    if association is None or not association.is_established \
+                            or not contexts <= negotiated:
+                        negotiated |= contexts
+                        association = self._ae.associate(
+                            self._address, self._port, ae_title=self._ae_title,
+                            contexts=[self._build_context(*context)
+                                      for context in sorted(negotiated)])
+                        if not association.is_established:
+                            warnings.warn('association with %s:%d rejected or aborted'
+                                          ', %d splits not forwarded'
+                                          % (self._address, self._port, len(batch)))
+                            count('splits_failed', len(batch))
+                            association = None
+                            continue
+                    with timed('c_store'):
+                        for dataset in batch:
+                            try:
+                                status = association.send_c_store(dataset)
+                            except (ValueError, RuntimeError) as error:
+                                status = None
+                                warnings.warn('%s not forwarded: %s'
+                                              % (dataset.SOPInstanceUID, error))
+                            # success and the warning statuses
+                            if status and status.Status in (0x0000, 0xB000, 0xB006, 0xB007):
+                                count('splits_forwarded')
+                            else:
+                                count('splits_failed')
+                            sent += 1
+                except Exception as error:
+                    # an association or socket error fails the rest of the
+                    # batch, the sender goes on draining the queue so put()
+                    # and close() never block on it
+                    warnings.warn('forwarding to %s:%d failed, %d splits not forwarded: %r'
+                                  % (self._address, self._port, len(batch) - sent, error))
+                    count('splits_failed', len(batch) - sent)
+                    if self._error is None:
+                        self._error = error
+                    if association is not None:
+                        with contextlib.suppress(Exception):
+                            association.abort()
+                    association = None
+        finally:
+            if association is not None and association.is_established:
+                with contextlib.suppress(Exception):
+                    association.release()
+
+    def close(self):
+        for _ in self._senders:
+            self._queue.put(None)
+        for sender in self._senders:
+            sender.join()
+        if self._error is not None:
+            raise self._error
+
+
+class SplitNode:
+    def __init__(self, port, forwarder, ae_title='PYDICOM_SPLIT',
+                 bind_address='', **options):
+        # a C-STORE SCP, every received instance is split in memory by
+        # split_dicom_datasets and the splits are handed to the forwarder
+        self._port = port
+        self._forwarder = forwarder
+        self._ae_title = ae_title
+        self._bind_address = bind_address
+        # the per-series state (UIDs, parsed patients) carries over between
+        # instances and associations
+        self._series_cache = SeriesCache(options.pop('cache_size', 128))
+        options['uid_namespace'] = make_uid_namespace(options.get('uid_namespace'))
+        self._options = options
+        self._incoming = queue.Queue(64)
+        self._server = None
+        self._splitting = None
 
-            if not study_instance_uids:
-                study_instance_uids = [x667_uuid() for i in range(n)]
+    @property
+    def port(self):
+        return self._port
 
-            if not series_instance_uids:
-                series_instance_uids = [x667_uuid() for i in range(n)]
+    @property
+    def forwarder(self):
+        return self._forwarder
 
-            for i, origin, pixel_array in dicom_splitter:
-                if parsed_patient_names[i] != 'blank':
-                    split_dataset = copy.deepcopy(dataset)
+    def _handle_store(self, event):
+        try:
+            dataset = event.dataset
+            dataset.file_meta = event.file_meta
+        except Exception:
+            # cannot understand
+            return 0xC210
+        count('instances_received')
+        # the status is only known once the instance is split, the sender
+        # waits for it like for any other storage
+        status = concurrent.futures.Future()
+        self._incoming.put((dataset, status))
+        return status.result()
+
+    def _split(self):
+        # one thread splits every instance in turn, a failed instance is
+        # reported to its sender and the next one is split as usual
+        for dataset, status in iter(self._incoming.get, None):
+            try:
+                splits = list(split_dicom_datasets([dataset], series_cache=self._series_cache,
+                                                   **self._options))
+            except Exception as error:
+                count('instances_failed')
+                warnings.warn('%s not split: %r' % (dataset.get('SOPInstanceUID'), error))
+                # cannot understand
+                status.set_result(0xC210)
+                continue
+            for i, patient, split_dataset in splits:
+                self._forwarder.put(split_dataset)
+            status.set_result(0x0000)
 
-                    if pixel_array is not None:
-                        set_pixel_data(split_dataset, pixel_array)
+    def start(self, block=False):
+        try:
+            from pynetdicom import AE, AllStoragePresentationContexts, evt
+            from pynetdicom.presentation import DEFAULT_TRANSFER_SYNTAXES
+        except ImportError:
+            raise Exception('[ERROR] the DICOM node needs pynetdicom')
+        try:
+            from pynetdicom.sop_class import Verification
+        except ImportError:
+            # pynetdicom < 2.0
+            from pynetdicom.sop_class import VerificationSOPClass as Verification
+        ae = AE(ae_title=self._ae_title)
+        for context in AllStoragePresentationContexts:
+            ae.add_supported_context(context.abstract_syntax,
+                                     DEFAULT_TRANSFER_SYNTAXES + [RLELossless])
+        ae.add_supported_context(Verification)
+        self._splitting = threading.Thread(target=self._split, daemon=True)
+        self._splitting.start()
+        handlers = [(evt.EVT_C_STORE, self._handle_store)]
+        address = (self._bind_address, self._port)
+        if block:
+            try:
+                ae.start_server(address, block=True, evt_handlers=handlers)
+            finally:
+                self._finish()
+        else:
+            self._server = ae.start_server(address, block=False,
+                                           evt_handlers=handlers)
+        return self
 
-                        if not keep_origin:
-                            affine_matrix = affine(dataset)
-                            position = affine_matrix.dot(numpy.append(origin, [0, 1]))
-                            # maximum 16 characters
-                            split_dataset.ImagePositionPatient = [str(p)[:16] for p in position[:3]]
+    def _finish(self):
+        self._incoming.put(None)
+        self._splitting.join()
+        self._forwarder.close()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+            self._finish()
+
+
+class Inotify:
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    MASK = 0x002 | 0x004 | 0x008 | 0x080 | 0x100
+    IN_ISDIR = 0x40000000
+    IN_Q_OVERFLOW = 0x4000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        # inotify(7) through libc, Linux only
+        libc_name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if libc is None or not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self._libc = libc
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._watches = {}
+
+    def add(self, directory):
+        # the whole tree below directory
+        for root, _ in scan_directory(directory):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root),
+                                              self.MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                warnings.warn('can not watch %s: %s' % (root, os.strerror(error)))
+                continue
+            self._watches[wd] = root
 
-                    split_dataset.SOPInstanceUID = x667_uuid()
-                    split_dataset.file_meta.MediaStorageSOPInstanceUID = split_dataset.SOPInstanceUID
+    def read(self, timeout=None):
+        # directories with events, None when events were lost
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self._fd, 2 ** 16)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            root = self._watches.get(wd)
+            if root is None:
+                continue
+            changed.add(root)
+            if mask & self.IN_ISDIR and name:
+                # a new subdirectory, may already hold files
+                path = os.path.join(root, name)
+                self.add(path)
+                changed.update(directory for directory, _ in scan_directory(path))
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class FolderWatcher:
+    def __init__(self, roots, interval=2.0, polling=False):
+        # inotify where available, else every directory is listed again
+        # each interval
+        self._roots = list(roots)
+        self._interval = interval
+        self._inotify = None
+        if not polling:
+            try:
+                self._inotify = Inotify()
+            except OSError as error:
+                warnings.warn('%s, polling every %g s' % (error, interval))
+        if self._inotify is not None:
+            for root in self._roots:
+                self._inotify.add(root)
+        self._first = True
 
-                    split_dataset.StudyInstanceUID = study_instance_uids[i]
+    @property
+    def polling(self):
+        return self._inotify is None
+
+    def changes(self):
+        # directories to list again, all of them on the first call, after
+        # lost events and when polling
+        if self._first or self._inotify is None:
+            self._first = False
+            if self._inotify is None:
+                time.sleep(self._interval)
+            return [root for top in self._roots for root, _ in scan_directory(top)]
+        changed = self._inotify.read(self._interval)
+        if changed is None:
+            warnings.warn('inotify queue overflowed, listing every directory')
+            return [root for top in self._roots for root, _ in scan_directory(top)]
+        return sorted(changed)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+
+class SplitDaemon:
+    def __init__(self, roots, settle=10.0, interval=2.0, polling=False,
+                 workers=None, cache_size=128, **options):
+        # splits new slices once their directory has been quiet for settle
+        # seconds; the series cache and the process pool live as long as
+        # the daemon so late slices join the same split series
+        self._roots = list(roots)
+        self._settle = settle
+        self._watcher = FolderWatcher(self._roots, interval, polling)
+        self._workers = workers
+        self._series_cache = SeriesCache(cache_size)
+        manifest = options.get('manifest')
+        if options.get('uid_namespace') is None and manifest is not None and \
+                os.path.exists(manifest) and os.path.getsize(manifest):
+            warnings.warn('resuming from %s without a UID namespace, the '
+                          'remaining splits get new UIDs' % manifest)
+        # one namespace for every batch, so slices of a series (or a study)
+        # settling in different batches keep the same UIDs
+        options['uid_namespace'] = make_uid_namespace(options.get('uid_namespace'))
+        self._options = options
+        # path -> (size, mtime) once split, (size, mtime, last change) before
+        self._done = {}
+        self._pending = collections.OrderedDict()
 
-                    split_dataset.SeriesInstanceUID = series_instance_uids[i]
-                    split_dataset.StorageMediaFileSetUID = series_instance_uids[i] + '.0'
+    @property
+    def roots(self):
+        return self._roots
 
-                    if series_descriptions:
-                        split_dataset.SeriesDescription = series_descriptions[i]
-                    else:
-                        if split_dataset.Modality == 'PT':
-                            split_dataset.SeriesDescription = parsed_patient_ids[i] + '.pet split'
-                        elif split_dataset.Modality == 'CT':
-                            split_dataset.SeriesDescription = parsed_patient_ids[i] + '.ct split'
-                        else:
-                            split_dataset.SeriesDescription += ' split'
-
-                    split_dataset.PatientName = parsed_patient_names[i]
-                    split_dataset.PatientID = parsed_patient_ids[i]
-
-                    split_dataset.SeriesNumber = (10 *  split_dataset.SeriesNumber) + i + 1
-
-                    if output_paths:
-                        output_path = os.path.join(output_paths, output_paths[i])
-                    elif mangle_output_paths:
-                        output_path = parsed_patient_ids[i] + id_trailing
-                    else:
-                        output_path = None
-                    created_output_path = make_output_path(newRoot, parsed_patient_names[i], output_path)
+    @property
+    def settle(self):
+        return self._settle
+
+    @property
+    def pending(self):
+        return list(self._pending)
+
+    def _update(self, directories):
+        now = time.monotonic()
+        for directory in directories:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.is_file() or entry.name == '.DS_Store':
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if self._done.get(entry.path) == signature:
+                    continue
+                pending = self._pending.get(entry.path)
+                if pending is None or pending[:2] != signature:
+                    self._pending[entry.path] = signature + (now,)
+
+    def _settled(self):
+        # directory -> paths, for directories without a change in settle s
+        now = time.monotonic()
+        last_change = {}
+        for path, (_, _, changed) in self._pending.items():
+            directory = os.path.dirname(path)
+            last_change[directory] = max(changed, last_change.get(directory, changed))
+        settled = collections.OrderedDict()
+        for path in self._pending:
+            directory = os.path.dirname(path)
+            if now - last_change[directory] >= self._settle:
+                settled.setdefault(directory, set()).add(path)
+        return settled
+
+    def _split(self, directory, paths, executor=None):
+        split_dicom_directory(directory, selected_paths=paths,
+                              series_cache=self._series_cache,
+                              executor=executor, **self._options)
+
+    def step(self, executor=None):
+        self._update(self._watcher.changes())
+        for directory, paths in self._settled().items():
+            count('batches')
+            try:
+                self._split(directory, paths, executor)
+            except Exception:
+                # retried file by file, only the files that fail on their
+                # own are given up on; they are not retried until changed
+                for path in sorted(paths):
+                    try:
+                        self._split(directory, {path}, executor)
+                    except Exception as error:
+                        count('files_failed')
+                        warnings.warn('%s not split: %r' % (path, error))
+            for path in paths:
+                size, mtime, _ = self._pending.pop(path)
+                self._done[path] = (size, mtime)
+
+    def run(self):
+        executor = None
+        if self._workers is not None and self._workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(self._workers)
+        try:
+            while True:
+                self.step(executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            self._watcher.close()
 
-                    filename = os.path.join(created_output_path, os.path.basename(path))
-                    split_dataset.save_as(filename)
 
 if __name__ == '__main__':
     import argparse
@@ -553,31 +3174,249 @@ if __name__ == '__main__':
                         help='set output path to split patient ID plus'
                              'trailing characters')
 
-    parser.add_argument('-order', '--order', help='order of patient placed in scanner', default='1,1,1')
-    parser.add_argument('-orderT', '--orderT', help='order of patient placed in scanner of top bed', default='1,1,1')
-    parser.add_argument('-orderB', '--orderB', help='order of patient placed in scanner of bottom bed', default='1,1,1')
+    parser.add_argument('-order', '--order', help='order of patient placed in scanner, default all 1 (1,1,1 for -n 3)')
+    parser.add_argument('-orderT', '--orderT', help='order of patient placed in scanner of top bed, default all 1')
+    parser.add_argument('-orderB', '--orderB', help='order of patient placed in scanner of bottom bed, default all 1')
     parser.add_argument('-offset', '--offset', type=int, default=5,
                         help='offset from center, default 5 percent from center')
-
-    group = parser.add_mutually_exclusive_group(required=True)
+    parser.add_argument('-gridOffsets', '--grid_offsets',
+                        help='move the top edge of each grid row up by a percent'
+                             ' of the rows, e.g. 0,5,5, default 0')
+    parser.add_argument('--auto', action='store_true',
+                        help='move the split lines into the gaps between subjects'
+                             ' and skip empty slots, found from a maximum'
+                             ' intensity projection of each series; replaces'
+                             ' -order, -orderT, -orderB and -offset')
+    parser.add_argument('--auto_threshold', type=float, default=0.1,
+                        help='--auto content threshold, as a fraction of the way'
+                             ' from background to the brightest pixels'
+                             ', default 0.1')
+    parser.add_argument('--trim', action='store_true',
+                        help='crop every split to the bounding box of its'
+                             ' content over the whole series')
+    parser.add_argument('--trim_threshold', type=float, default=0.1,
+                        help='--trim content threshold, as a fraction of the way'
+                             ' from background to the brightest pixels'
+                             ', default 0.1')
+    parser.add_argument('--trim_margin', type=int, default=10,
+                        help='pixels kept around the --trim bounding box'
+                             ', default 10')
+    parser.add_argument('--reference', metavar='MODALITY_OR_UID',
+                        help='lay out only this series of each study (e.g. CT)'
+                             ' and crop the same patient space in every other'
+                             ' series of the study, e.g. the PET')
+    parser.add_argument('-A', '--archive', choices=ARCHIVE_FORMATS,
+                        help='stream the splits into tar or zip archives'
+                             ', default one file per slice')
+    parser.add_argument('--archive_per', choices=('subject', 'run'),
+                        default='subject',
+                        help='one archive per subject next to its directory'
+                             ', or one per DICOM_DIRECTORY in the output'
+                             ' directory, default subject')
+    parser.add_argument('-E', '--encoding', choices=list(ENCODINGS),
+                        help='write the splits as RLE Lossless or Deflated'
+                             ' Explicit VR Little Endian, default uncompressed')
+    parser.add_argument('--encoders', type=int,
+                        help='processes encoding the splits, default one per'
+                             ' CPU (with --workers each worker encodes its own)')
+    parser.add_argument('--scp', type=int, metavar='PORT',
+                        help='run as a DICOM node: receive instances over'
+                             ' C-STORE on PORT, split them in memory and'
+                             ' forward the splits to --forward')
+    parser.add_argument('--ae_title', default='PYDICOM_SPLIT',
+                        help='AE title of the node, default PYDICOM_SPLIT')
+    parser.add_argument('--forward', metavar='HOST:PORT',
+                        help='C-STORE destination of the splits')
+    parser.add_argument('--forward_ae_title', default='ANY-SCP',
+                        help='AE title of the destination, default ANY-SCP')
+    parser.add_argument('--associations', type=int, default=1,
+                        help='associations kept open to the destination'
+                             ', default 1')
+    parser.add_argument('--batch_size', type=int, default=16,
+                        help='splits sent per batch, default 16')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and split new slices in'
+                             ' DICOM_DIRECTORY as they arrive')
+    parser.add_argument('--settle', type=float, default=10,
+                        help='seconds a directory has to stay unchanged'
+                             ' before its new slices are split, default 10')
+    parser.add_argument('--interval', type=float, default=2,
+                        help='seconds between checks (and between listings'
+                             ' when polling), default 2')
+    parser.add_argument('--polling', action='store_true',
+                        help='list the directories every interval instead'
+                             ' of using inotify')
+    parser.add_argument('-V', '--volume', action='store_true',
+                        help='split each series as one stacked volume'
+                             ', default file by file')
+    parser.add_argument('-I', '--index',
+                        help='SQLite header index, files unchanged since the'
+                             ' last run are not parsed again to be scanned'
+                             ', and --auto and --trim map their pixels'
+                             ' straight from the indexed offset; each file'
+                             ' is still parsed once when it is split, for the'
+                             ' header of its splits')
+    parser.add_argument('-N', '--uid_namespace',
+                        help='derive every new UID from the source UIDs'
+                             ' under this namespace, default random UIDs')
+    parser.add_argument('-M', '--manifest',
+                        help='record finished splits in this file and skip'
+                             ' them when the run is resumed')
+    parser.add_argument('-P', '--pipeline', action='store_true',
+                        help='overlap reading, splitting and writing in'
+                             ' threads connected by bounded queues')
+    parser.add_argument('--readers', type=int, default=2,
+                        help='pipeline reader threads, default 2')
+    parser.add_argument('--writers', type=int, default=2,
+                        help='pipeline writer threads, default 2')
+    parser.add_argument('--memory_budget', type=lambda mb: int(float(mb) * 2 ** 20),
+                        default=512 * 2 ** 20,
+                        help='pipeline memory budget in MB, default 512')
+    parser.add_argument('--frame_memory', type=lambda mb: int(float(mb) * 2 ** 20),
+                        default=64 * 2 ** 20,
+                        help='multi-frame splits larger than this are written'
+                             ' in chunks of frames of at most this many MB'
+                             ', default 64')
+    parser.add_argument('--profile',
+                        help='write per-stage timings and counters to this'
+                             ' JSON file')
+    parser.add_argument('--metrics_file',
+                        help='write per-stage timings and counters to this'
+                             ' Prometheus textfile collector file')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='split files in a pool of N processes'
+                             ', default serial')
+
+    parser.add_argument('--plan', metavar='PLAN',
+                        help='read headers only and write every output\'s crop'
+                             ' box, position, patient, UIDs and destination to'
+                             ' this JSON (or .csv) file instead of splitting')
+    parser.add_argument('--from_plan', metavar='PLAN',
+                        help='split exactly as planned in this --plan file')
+
+    # not needed to run a plan
+    group = parser.add_mutually_exclusive_group()
     group.add_argument('-n', type=int, help='split into N volumes')
     group.add_argument('-nTB', nargs='*', help='split into N volumes of top and bottom beds')
+    group.add_argument('-grid', '--grid',
+                       help='split into a grid of beds, columns per row from top'
+                            ' to bottom, e.g. 3,3,3; -order masks the cells row'
+                            ' by row')
 
     group.add_argument('-u', '--series_instance_uids', nargs='*', default=[],
                        help='split volume for each series instance UID')
 
     kwargs = vars(parser.parse_args())
+    if kwargs['from_plan'] is None and kwargs['n'] is None and \
+            kwargs['nTB'] is None and kwargs['grid'] is None and \
+            not kwargs['series_instance_uids']:
+        parser.error('one of the arguments -n -nTB -grid/--grid'
+                     ' -u/--series_instance_uids is required')
+
+    if kwargs['auto']:
+        # the order of every series comes from its own layout
+        kwargs['order'] = kwargs['orderT'] = kwargs['orderB'] = None
 
     directories = kwargs.pop('DICOM_DIRECTORY')
+    plan = kwargs.pop('plan')
+    from_plan = kwargs.pop('from_plan')
+    if (plan is not None or from_plan is not None) and \
+            (kwargs['archive'] is not None or kwargs['scp'] is not None or kwargs['watch']):
+        raise Exception('[ERROR] a plan is split into files'
+                        ', it can not be combined with archive, scp or watch')
+    profile = kwargs.pop('profile')
+    metrics_file = kwargs.pop('metrics_file')
+
+    scp = kwargs.pop('scp')
+    watch = kwargs.pop('watch')
+    watch_options = dict(settle=kwargs.pop('settle'),
+                         interval=kwargs.pop('interval'),
+                         polling=kwargs.pop('polling'))
+    forward = kwargs.pop('forward')
+    node_options = dict(ae_title=kwargs.pop('ae_title'),
+                        forward_ae_title=kwargs.pop('forward_ae_title'),
+                        associations=kwargs.pop('associations'),
+                        batch_size=kwargs.pop('batch_size'))
+    if scp is not None:
+        if forward is None:
+            raise Exception('[ERROR] --scp needs a --forward destination')
+        if directories:
+            raise Exception('[ERROR] --scp receives over the network'
+                            ', it can not be combined with DICOM_DIRECTORY')
+        # split options only, a long running node derives the study UIDs
+        # from each source study instead of sharing one set
+        split_options = {key: kwargs[key] for key in (
+            'axis', 'n', 'nTB', 'offset', 'keep_origin', 'study_instance_uids',
+            'series_instance_uids', 'series_descriptions',
+            'derivation_description', 'patient_names', 'patient_ids', 'order',
+            'orderT', 'orderB', 'uid_namespace', 'grid', 'grid_offsets',
+            'encoding')}
 
     shared = not kwargs.pop('unique_study_instance_uids')
-    if shared and not kwargs.get('study_instance_uids'):
-        if kwargs.get('nTB') is not None:
-            n = int(kwargs.get('nTB')[0].split(',')[0]) + int(kwargs.get('nTB')[0].split(',')[1])
+    if scp is None and not watch and from_plan is None and shared and \
+            not kwargs.get('study_instance_uids'):
+        if kwargs.get('grid') is not None:
+            n = sum(int(c) for c in kwargs.get('grid').split(','))
+            n = len(kwargs.get('series_instance_uids')) or n
+        elif kwargs.get('nTB') is not None:
+            n = sum(split_counts(kwargs.get('nTB')))
             n = len(kwargs.get('series_instance_uids')) or n
         else:
             n = len(kwargs.get('series_instance_uids')) or kwargs.get('n')
-        kwargs['study_instance_uids'] = [x667_uuid() for i in range(n)]
-
-    for directory in directories:
-        split_dicom_directory(directory, **kwargs)
+        if kwargs.get('uid_namespace') is not None:
+            namespace = make_uid_namespace(kwargs.get('uid_namespace'))
+            kwargs['study_instance_uids'] = [derived_uid(namespace, 'StudyInstanceUID', i)
+                                             for i in range(n)]
+        else:
+            kwargs['study_instance_uids'] = [x667_uuid() for i in range(n)]
+
+    if scp is not None or watch:
+        # stopped by a service manager like by Ctrl-C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    def run():
+        if scp is not None:
+            address, port = forward.rsplit(':', 1)
+            forwarder = StoreForwarder(address, int(port),
+                                       node_options['forward_ae_title'],
+                                       node_options['ae_title'],
+                                       node_options['associations'],
+                                       node_options['batch_size'])
+            node = SplitNode(scp, forwarder, node_options['ae_title'],
+                             **split_options)
+            try:
+                node.start(block=True)
+            except KeyboardInterrupt:
+                pass
+        elif watch:
+            workers = kwargs.pop('workers')
+            daemon = SplitDaemon(directories, workers=workers,
+                                 **dict(watch_options, **kwargs))
+            try:
+                daemon.run()
+            except KeyboardInterrupt:
+                pass
+        elif from_plan is not None:
+            with timed('total'):
+                split_dicom_plan(from_plan, kwargs['workers'],
+                                 kwargs['encoding'], kwargs['encoders'],
+                                 kwargs['frame_memory'], kwargs['manifest'])
+        elif plan is not None:
+            plan_rows = []
+            for directory in directories:
+                split_dicom_directory(directory, plan_rows=plan_rows, **kwargs)
+            write_plan(plan, plan_rows)
+        else:
+            for directory in directories:
+                with timed('total'):
+                    split_dicom_directory(directory, **kwargs)
+
+    if profile or metrics_file:
+        with profiling() as run_metrics:
+            run()
+        if profile:
+            run_metrics.write_json(profile)
+        if metrics_file:
+            run_metrics.write_prometheus(metrics_file)
+    else:
+        run()
@@ -0,0 +1,18 @@
+import os
+import sys
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pydicom_split
+
+
+def test_non_divisible_counted_per_use():
+    # the plan is cached, its warning is still counted every time it is used
+    splitter = pydicom_split.DICOMSplitter(None, 1, 7)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with pydicom_split.profiling() as run_metrics:
+            for _ in range(3):
+                pydicom_split.crop_plan(splitter, (500, 960))
+            pydicom_split.crop_plan(splitter, (500, 960), 10)
+    assert run_metrics.snapshot()['counters']['warnings_non_divisible_axis'] == 13
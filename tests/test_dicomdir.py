@@ -0,0 +1,49 @@
+import glob
+import os
+import shutil
+import sys
+
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pydicom_split
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'test', 'SingRowLastOneEmpty')
+
+
+def write_dicomdir(path, records):
+    dicomdir = Dataset()
+    dicomdir.file_meta = FileMetaDataset()
+    dicomdir.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.1.3.10'
+    dicomdir.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    dicomdir.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dicomdir.DirectoryRecordSequence = Sequence()
+    for record_type, file_id in records:
+        record = Dataset()
+        record.DirectoryRecordType = record_type
+        record.ReferencedFileID = file_id
+        dicomdir.DirectoryRecordSequence.append(record)
+    dicomdir.is_little_endian, dicomdir.is_implicit_VR = True, False
+    dicomdir.save_as(path, write_like_original=False)
+
+
+def test_file_ids_resolve_from_the_dicomdir(tmp_path):
+    # IMAGE records in a subdirectory are trusted, any other record type
+    # is never opened
+    (tmp_path / 'SUB').mkdir()
+    path = sorted(glob.glob(os.path.join(TEST_DIR, '*.dcm')))[0]
+    shutil.copy(path, str(tmp_path / 'SUB' / 'img1'))
+    shutil.copy(path, str(tmp_path / 'SUB' / 'other'))
+    write_dicomdir(str(tmp_path / 'DICOMDIR'),
+                   [('IMAGE', ['SUB', 'IMG1']), ('PRIVATE', ['SUB', 'OTHER'])])
+    dicomdir = (set(), set())
+    found = []
+    for root, files in pydicom_split.scan_directory(str(tmp_path)):
+        found.extend(pydicom_split.DICOMDirectory(root, stop_before_pixels=True,
+                                                  entries=files, dicomdir=dicomdir))
+    assert [os.path.basename(path) for path, _ in found] == ['img1']
+    assert pydicom_split.dicomdir_key(str(tmp_path / 'SUB' / 'img1')) in dicomdir[0]
@@ -0,0 +1,28 @@
+import os
+import sys
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pydicom_split
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'test', 'SingleRow')
+
+
+def test_resume_with_a_masked_cell(tmp_path):
+    # three subjects, the middle cell is masked and never written, the
+    # files are still complete
+    manifest = str(tmp_path / 'manifest.txt')
+    counters = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for _ in range(2):
+            with pydicom_split.profiling() as run_metrics:
+                pydicom_split.split_dicom_directory(
+                    TEST_DIR, grid='3', order='1,0,1',
+                    output_dir=str(tmp_path / 'out'), manifest=manifest,
+                    uid_namespace='resume')
+            counters.append(run_metrics.snapshot()['counters'])
+    assert counters[0]['files_written'] == 6
+    assert 'files_read' not in counters[1]
+    assert 'files_written' not in counters[1]
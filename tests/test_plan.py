@@ -0,0 +1,27 @@
+import os
+import sys
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pydicom_split
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'test', 'TwoRows')
+
+
+def test_plan_twice_over_one_index(tmp_path):
+    # the second run answers the scan from the index
+    index = str(tmp_path / 'index.db')
+    plans = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for _ in range(2):
+            plan_rows = []
+            pydicom_split.split_dicom_directory(
+                TEST_DIR, nTB=['1,2'], orderT='1', orderB='1,1',
+                output_dir=str(tmp_path / 'out'), index=index,
+                uid_namespace='plan', plan_rows=plan_rows)
+            plans.append(plan_rows)
+    assert len(plans[0]) == 9
+    assert plans[1] == plans[0]
+    assert not os.path.exists(str(tmp_path / 'out'))
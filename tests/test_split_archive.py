@@ -0,0 +1,46 @@
+import os
+import shutil
+import sys
+import tarfile
+import warnings
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pydicom_split
+
+
+def members(path):
+    if path.endswith('.tar'):
+        with tarfile.open(path) as archive:
+            return {info.name: archive.extractfile(info).read()
+                    for info in archive.getmembers()}
+    with zipfile.ZipFile(path) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+@pytest.mark.parametrize('format', pydicom_split.ARCHIVE_FORMATS)
+@pytest.mark.parametrize('cut', [0, 100, 700])
+def test_resume_killed_archive(tmp_path, format, cut):
+    subject = str(tmp_path / 'subject')
+    path = subject + '.' + format
+    archive = pydicom_split.SplitArchive(format)
+    for i in range(6):
+        archive.add(subject, '%d.dcm' % i, bytes([i]) * 1000)
+    # what a kill leaves on disk: flushed members but no end records,
+    # cut is a member interrupted while it was written
+    archive.flush()
+    shutil.copy(path, path + '.killed')
+    archive.close()
+    os.replace(path + '.killed', path)
+    with open(path, 'r+b') as fp:
+        fp.truncate(os.path.getsize(path) - cut)
+
+    archive = pydicom_split.SplitArchive(format)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for i in range(9):
+            archive.add(subject, '%d.dcm' % i, bytes([i]) * 1000)
+    archive.close()
+    assert members(path) == {'subject/%d.dcm' % i: bytes([i]) * 1000 for i in range(9)}
@@ -0,0 +1,63 @@
+import glob
+import os
+import shutil
+import sys
+import warnings
+
+import pydicom
+import pydicom.uid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pydicom_split
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'test', 'SingRowLastOneEmpty')
+
+
+def test_batches_share_study_uids(tmp_path):
+    incoming, output = tmp_path / 'in', tmp_path / 'out'
+    (incoming / 'a').mkdir(parents=True)
+    (incoming / 'b').mkdir()
+    output.mkdir()
+    path = sorted(glob.glob(os.path.join(TEST_DIR, '*.dcm')))[0]
+    daemon = pydicom_split.SplitDaemon([str(incoming)], settle=0, polling=True,
+                                       n=3, order='1,1,0', output_dir=str(output))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        shutil.copy(path, str(incoming / 'a'))
+        daemon.step()
+        # another series of the same study, settled in a later batch
+        dataset = pydicom.dcmread(path)
+        dataset.SeriesInstanceUID = pydicom.uid.generate_uid()
+        dataset.SOPInstanceUID = pydicom.uid.generate_uid()
+        dataset.save_as(str(incoming / 'b' / 'later.dcm'))
+        daemon.step()
+    studies = {}
+    for split in glob.glob(str(output / '**' / '*.dcm'), recursive=True):
+        dataset = pydicom.dcmread(split, stop_before_pixels=True)
+        studies.setdefault(str(dataset.PatientName), set()).add(dataset.StudyInstanceUID)
+    assert len(studies) == 2
+    assert all(len(uids) == 1 for uids in studies.values())
+
+
+def test_bad_file_is_given_up_on(tmp_path):
+    incoming, output = tmp_path / 'in', tmp_path / 'out'
+    (incoming / 'a').mkdir(parents=True)
+    output.mkdir()
+    path = sorted(glob.glob(os.path.join(TEST_DIR, '*.dcm')))[0]
+    shutil.copy(path, str(incoming / 'a' / 'good.dcm'))
+    # a series of its own whose patient name can not be split
+    dataset = pydicom.dcmread(path)
+    dataset.PatientName = dataset.PatientID = 'NOUNDERSCORE'
+    dataset.SeriesInstanceUID = pydicom.uid.generate_uid()
+    dataset.SOPInstanceUID = pydicom.uid.generate_uid()
+    dataset.save_as(str(incoming / 'a' / 'bad.dcm'))
+    daemon = pydicom_split.SplitDaemon([str(incoming)], settle=0, polling=True,
+                                       n=3, order='1,1,0', output_dir=str(output))
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        daemon.step()
+        daemon.step()
+    assert any('bad.dcm not split' in str(warning.message) for warning in caught)
+    assert len(glob.glob(str(output / '**' / '*.dcm'), recursive=True)) == 2
+    assert not daemon.pending
@@ -0,0 +1,124 @@
+import glob
+import os
+import socket
+import sys
+import threading
+import warnings
+
+import pytest
+
+import pydicom
+
+pynetdicom = pytest.importorskip('pynetdicom')
+from pynetdicom import AE, AllStoragePresentationContexts, StoragePresentationContexts, evt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pydicom_split
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'test', 'SingRowLastOneEmpty')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def loopback():
+    # destination SCP <- forwarder <- split node <- scanner SCU
+    received = []
+
+    def on_store(event):
+        dataset = event.dataset
+        dataset.file_meta = event.file_meta
+        received.append(dataset)
+        return 0x0000
+
+    destination_port, node_port = free_port(), free_port()
+    destination = AE(ae_title='DEST')
+    destination.supported_contexts = AllStoragePresentationContexts
+    server = destination.start_server(('127.0.0.1', destination_port), block=False,
+                                      evt_handlers=[(evt.EVT_C_STORE, on_store)])
+    forwarder = pydicom_split.StoreForwarder('127.0.0.1', destination_port, 'DEST',
+                                             batch_size=4, batch_timeout=0.1)
+    node = pydicom_split.SplitNode(node_port, forwarder, bind_address='127.0.0.1',
+                                   axis=1, n=3, order='1,1,0',
+                                   uid_namespace='loopback').start()
+    scanner = AE(ae_title='SCANNER')
+    scanner.requested_contexts = StoragePresentationContexts
+
+    def send(datasets):
+        association = scanner.associate('127.0.0.1', node_port)
+        assert association.is_established
+        statuses = [association.send_c_store(dataset).Status for dataset in datasets]
+        association.release()
+        return statuses
+
+    try:
+        yield send, received, node
+    finally:
+        node.stop()
+        server.shutdown()
+
+
+def test_splits_are_forwarded(loopback):
+    send, received, node = loopback
+    paths = sorted(glob.glob(os.path.join(TEST_DIR, '*.dcm')))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        # one association per instance, the series state carries over
+        statuses = [status for path in paths for status in send([pydicom.dcmread(path)])]
+        node.stop()
+    assert statuses == [0x0000] * len(paths)
+    # the right slot is empty
+    assert len(received) == 2 * len(paths)
+    assert len({dataset.SeriesInstanceUID for dataset in received}) == 2
+    assert {str(dataset.PatientName) for dataset in received} == \
+        {'425362-245-T_1516', '425362-245-T_1517'}
+
+
+def test_failed_instance_is_reported(loopback):
+    send, received, node = loopback
+    path = sorted(glob.glob(os.path.join(TEST_DIR, '*.dcm')))[0]
+    bad = pydicom.dcmread(path)
+    bad.PatientName = bad.PatientID = 'NOUNDERSCORE'
+    bad.SeriesInstanceUID = pydicom.uid.generate_uid()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        statuses = send([bad, pydicom.dcmread(path)])
+        node.stop()
+    # the bad instance is refused, the next one is still split and forwarded
+    assert statuses[0] != 0x0000
+    assert statuses[1] == 0x0000
+    assert len(received) == 2
+
+
+def test_forwarder_survives_a_socket_error():
+    forwarder = pydicom_split.StoreForwarder('127.0.0.1', free_port(), 'DEST',
+                                             batch_size=2, batch_timeout=0.1)
+
+    def associate(*args, **kwargs):
+        raise ConnectionResetError('peer went away')
+
+    forwarder._ae.associate = associate
+    dataset = pydicom.dcmread(sorted(glob.glob(os.path.join(TEST_DIR, '*.dcm')))[0])
+    errors = []
+
+    def put_and_close():
+        # more than the queue holds, a dead sender would block here
+        for _ in range(20):
+            forwarder.put(dataset)
+        try:
+            forwarder.close()
+        except ConnectionResetError as error:
+            errors.append(error)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        thread = threading.Thread(target=put_and_close, daemon=True)
+        thread.start()
+        thread.join(30)
+    assert not thread.is_alive()
+    assert len(errors) == 1
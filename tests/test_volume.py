@@ -0,0 +1,35 @@
+import glob
+import os
+import sys
+import warnings
+
+import numpy
+import pydicom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pydicom_split
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'test', 'SingleRow')
+
+
+def test_mixed_dtypes_keep_their_own(tmp_path):
+    # one signed slice promotes the stacked volume to int32
+    (tmp_path / 'in').mkdir()
+    for k, path in enumerate(sorted(glob.glob(os.path.join(TEST_DIR, '*.dcm')))):
+        dataset = pydicom.dcmread(path)
+        if k == 0:
+            dataset.PixelData = dataset.pixel_array.astype(numpy.int16).tobytes()
+            dataset.PixelRepresentation = 1
+        dataset.save_as(str(tmp_path / 'in' / ('%d.dcm' % k)))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        pydicom_split.split_dicom_directory(str(tmp_path / 'in'), n=3, volume=True,
+                                            output_dir=str(tmp_path / 'out'))
+    splits = glob.glob(str(tmp_path / 'out' / '**' / '*.dcm'), recursive=True)
+    assert len(splits) == 9
+    for split in splits:
+        dataset = pydicom.dcmread(split)
+        assert len(dataset.PixelData) == dataset.Rows * dataset.Columns * 2
+        assert dataset.pixel_array.dtype == (numpy.int16 if split.endswith('0.dcm')
+                                             else numpy.uint16)